@@ -1,12 +1,15 @@
 from django.contrib import admin
+from django.db import connection
+from django.db.models import Q
 
 from .models import *
+from .routers import LecturaReplicaAdminMixin, fijar_primaria
 # Register your models here.
 
 class CampoDefinidoInline(admin.TabularInline):
     model = CampoDefinido
     extra = 1
-    fields = ('etiqueta', 'tipo', 'tipo_original', 'default_value', 'values', 'validate', 'conditional', 'validate_when_hidden', 'visible_para', 'activo')
+    fields = ('etiqueta', 'tipo', 'tipo_original', 'default_value', 'values', 'validate', 'conditional', 'validate_when_hidden', 'indexado', 'visible_para', 'activo')
     readonly_fields = ('clave', 'etiqueta', 'tipo', 'tipo_original')
     autocomplete_fields = ['visible_para']
     show_change_link = True
@@ -15,8 +18,8 @@ class CampoDefinidoInline(admin.TabularInline):
     min_num = 1
 
 @admin.register(Formulario)
-class FormularioAdmin(admin.ModelAdmin):
-    list_display = ('nombre', 'fecha')
+class FormularioAdmin(LecturaReplicaAdminMixin, admin.ModelAdmin):
+    list_display = ('nombre', 'fecha', 'almacenamiento', 'limpiar_ocultos')
     search_fields = ('nombre',)
     inlines = [CampoDefinidoInline]
     ordering = ('-fecha',)
@@ -26,6 +29,20 @@ class FormularioAdmin(admin.ModelAdmin):
     list_select_related = True
     actions = ['exportar_csv']
 
+    def get_queryset(self, request):
+        # Los pendientes de purga ya no existen para el usuario
+        return super().get_queryset(request).filter(eliminacion_pendiente=False)
+
+    def delete_model(self, request, obj):
+        # Se purga en segundo plano con `purgar_eliminados`
+        obj.eliminacion_pendiente = True
+        obj.save(update_fields=['eliminacion_pendiente'])
+        fijar_primaria(request)
+
+    def delete_queryset(self, request, queryset):
+        queryset.update(eliminacion_pendiente=True)
+        fijar_primaria(request)
+
 
 class RespuestaEncuestaInline(admin.TabularInline):
     model = RespuestaEncuesta
@@ -36,7 +53,7 @@ class RespuestaEncuestaInline(admin.TabularInline):
     can_delete = True
 
 @admin.register(Encuesta)
-class EncuestaAdmin(admin.ModelAdmin):
+class EncuestaAdmin(LecturaReplicaAdminMixin, admin.ModelAdmin):
     list_display = ('nombre', 'formulario', 'activa', 'fecha_inicio', 'fecha_fin')
     search_fields = ('nombre', 'descripcion')
     inlines = [RespuestaEncuestaInline]
@@ -46,14 +63,65 @@ class EncuestaAdmin(admin.ModelAdmin):
     list_per_page = 20
     list_select_related = True
 
+    def get_queryset(self, request):
+        # Los pendientes de purga (o de un formulario pendiente) ya no existen para el usuario
+        return super().get_queryset(request).filter(eliminacion_pendiente=False, formulario__eliminacion_pendiente=False)
+
+    def delete_model(self, request, obj):
+        # Se purga en segundo plano con `purgar_eliminados`
+        obj.eliminacion_pendiente = True
+        obj.save(update_fields=['eliminacion_pendiente'])
+        fijar_primaria(request)
+
+    def delete_queryset(self, request, queryset):
+        queryset.update(eliminacion_pendiente=True)
+        fijar_primaria(request)
+
 
 @admin.register(CampoRespuesta)
-class CampoRespuestaAdmin(admin.ModelAdmin):
+class CampoRespuestaAdmin(LecturaReplicaAdminMixin, admin.ModelAdmin):
     list_display = ('respuesta', 'etiqueta', 'clave', 'valor', 'valor_numerico', 'valor_fecha', 'valor_time', 'valor_datetime', 'valor_booleano', 'valor_lista')
-    search_fields = ('respuesta__encuesta__nombre', 'clave', 'valor')
+    search_fields = ('respuesta__encuesta__nombre', 'campo_definido__clave', 'valor')
     list_filter = ('respuesta__encuesta__formulario',)
     ordering = ('-respuesta__enviado',)
     date_hierarchy = 'respuesta__enviado'
     list_per_page = 20
     list_select_related = True
-    
\ No newline at end of file
+
+    def get_search_results(self, request, queryset, search_term):
+        resultado, duplicados = super().get_search_results(request, queryset, search_term)
+        if not search_term:
+            return resultado, duplicados
+
+        # Las respuestas de opciones se guardan codificadas (valor=''): buscar también en OpcionCampo
+        opciones = OpcionCampo.objects.filter(
+            Q(valor__icontains=search_term) | Q(etiqueta__icontains=search_term)
+        ).values_list('campo_definido_id', 'codigo')[:100]
+        filtro = Q()
+        for campo_definido_id, codigo in opciones:
+            filtro |= Q(campo_definido_id=campo_definido_id, valor_codigo=codigo)
+            if connection.features.supports_json_field_contains:
+                filtro |= Q(campo_definido_id=campo_definido_id, valor_codigos__contains=[codigo])
+                filtro |= Q(campo_definido_id=campo_definido_id, valor_codigos__contains={str(codigo): True})
+        if filtro:
+            resultado = resultado | queryset.filter(filtro)
+        return resultado, duplicados
+
+
+@admin.register(TareaRetipado)
+class TareaRetipadoAdmin(LecturaReplicaAdminMixin, admin.ModelAdmin):
+    list_display = ('campo_definido', 'tipo_anterior', 'tipo_nuevo', 'procesados', 'no_convertibles', 'completada', 'creada_en')
+    list_filter = ('completada',)
+    readonly_fields = ('ultimo_id', 'procesados', 'no_convertibles', 'errores')
+    ordering = ('-creada_en',)
+    list_per_page = 20
+
+
+@admin.register(EventoSalida)
+class EventoSalidaAdmin(LecturaReplicaAdminMixin, admin.ModelAdmin):
+    list_display = ('tipo', 'encuesta', 'respuesta_id', 'estado', 'intentos', 'proximo_intento', 'creado_en', 'enviado_en')
+    list_filter = ('estado', 'tipo')
+    readonly_fields = ('payload', 'ultimo_error')
+    ordering = ('-id',)
+    list_per_page = 20
+
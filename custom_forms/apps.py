@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class CustomFormsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'custom_forms'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,259 @@
+"""
+Lectura incremental de envíos grandes.
+
+Las respuestas de un envío se leen campo a campo del objeto JSON (cuerpo de la petición con
+Content-Type application/json, o el campo `respuestas` del formulario), sin construir el árbol
+completo antes de procesarlo. Límites en settings:
+
+    CUSTOM_FORMS_MAX_ENVIO_BYTES = 20 * 1024 * 1024      # tamaño total del envío
+    CUSTOM_FORMS_MAX_CAMPO_BYTES = 10 * 1024 * 1024      # tamaño de un valor
+    CUSTOM_FORMS_ARCHIVAR_DESDE_BYTES = 256 * 1024       # textos mayores van a default_storage
+    CUSTOM_FORMS_ARCHIVOS_DIR = 'custom_forms/valores/'
+
+Los textos archivados (firmas o archivos en base64, por ejemplo) se guardan en `valor`/`datos`
+como una referencia `custom_forms_archivo:<nombre>`; resolver_archivados la reemplaza por el contenido.
+Cada archivo pertenece al envío que lo creó; los que ya no referencia ninguna respuesta se eliminan
+con el comando `purgar_archivados`.
+"""
+import codecs, io, json, re, uuid
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+
+PREFIJO_ARCHIVADO = 'custom_forms_archivo:'
+REFERENCIA_ARCHIVADO = re.compile(re.escape(PREFIJO_ARCHIVADO) + r'([^"\\]+)')
+ESPACIOS = ' \t\n\r'
+CONTINUACION_NUMERO = '0123456789.eE+-'
+
+_decodificador = json.JSONDecoder()
+
+
+class LimiteEnvioExcedido(ValueError):
+    pass
+
+
+class LectorObjetoJSON:
+    """
+    Recorre los miembros de un objeto JSON de primer nivel leyendo el flujo por bloques.
+    Solo se mantiene en memoria el valor que se está decodificando.
+    """
+    def __init__(self, flujo, max_envio=None, max_campo=None, tamano_bloque=64 * 1024):
+        self.flujo = flujo  # Cualquier objeto con read(n) que devuelva bytes o texto
+        self.max_envio = max_envio
+        self.max_campo = max_campo
+        self.tamano_bloque = tamano_bloque
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = ''
+        self.pos = 0
+        self.pendiente = []  # Bloques leídos aún no unidos al buffer
+        self.largo_pendiente = 0
+        self.leidos = 0
+        self.fin = False
+
+    def _leer_bloque(self):
+        if self.fin:
+            return False
+        bloque = self.flujo.read(self.tamano_bloque)
+        if not bloque:
+            self.fin = True
+            resto = self.utf8.decode(b'', final=True)
+            if resto:
+                self.pendiente.append(resto)
+                self.largo_pendiente += len(resto)
+            return False
+
+        if isinstance(bloque, bytes):
+            self.leidos += len(bloque)
+            texto = self.utf8.decode(bloque)
+        else:
+            self.leidos += len(bloque.encode('utf-8'))
+            texto = bloque
+        if self.max_envio and self.leidos > self.max_envio:
+            raise LimiteEnvioExcedido(f"El envío supera el tamaño máximo de {self.max_envio} bytes")
+
+        self.pendiente.append(texto)
+        self.largo_pendiente += len(texto)
+        return True
+
+    def _consolidar(self):
+        if self.pendiente:
+            # Se descarta lo ya procesado para que el buffer no crezca con todo el envío
+            self.buffer = self.buffer[self.pos:] + ''.join(self.pendiente)
+            self.pos = 0
+            self.pendiente = []
+            self.largo_pendiente = 0
+
+    def _disponible(self):
+        return len(self.buffer) - self.pos + self.largo_pendiente
+
+    def _caracter(self):
+        """Devuelve el siguiente carácter que no es espacio, sin consumirlo."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in ESPACIOS:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._leer_bloque() and not self.pendiente:
+                raise ValueError("El JSON del envío está incompleto")
+            self._consolidar()
+
+    def _excede_max_campo(self, fin):
+        """
+        Indica si el valor en buffer[pos:fin] supera max_campo en bytes UTF-8 (como cuenta max_envio).
+        Solo se codifica cuando el número de caracteres no basta para decidirlo (1 a 4 bytes por carácter).
+        """
+        caracteres = fin - self.pos
+        if caracteres > self.max_campo:
+            return True
+        if 4 * caracteres <= self.max_campo:
+            return False
+        return len(self.buffer[self.pos:fin].encode('utf-8')) > self.max_campo
+
+    def _valor(self, clave=None):
+        """
+        Decodifica el valor que empieza en la posición actual. Si el buffer no lo contiene completo
+        se leen bloques hasta duplicar lo disponible antes de reintentar, para no re-escanear por bloque.
+        """
+        self._caracter()
+        requerido = 0
+        while True:
+            if self._disponible() >= requerido or self.fin:
+                self._consolidar()
+                try:
+                    valor, fin = _decodificador.raw_decode(self.buffer, self.pos)
+                except json.JSONDecodeError:
+                    if self.fin:
+                        raise
+                else:
+                    # Un número al final del buffer podría continuar en el próximo bloque ("-12" + "5.0"):
+                    # el valor está completo solo si lo que sigue no puede ser parte de él
+                    siguiente = fin
+                    while siguiente < len(self.buffer) and self.buffer[siguiente] in ESPACIOS:
+                        siguiente += 1
+                    if self.fin or (siguiente < len(self.buffer) and self.buffer[siguiente] not in CONTINUACION_NUMERO):
+                        if self.max_campo and self._excede_max_campo(fin):
+                            raise LimiteEnvioExcedido(f"El campo '{clave}' supera el tamaño máximo de {self.max_campo} bytes")
+                        self.pos = fin
+                        return valor
+                    requerido = self._disponible() + 1  # Basta con leer hasta el delimitador
+                    self._leer_bloque()
+                    continue
+
+                # Cada carácter ocupa al menos un byte: con más caracteres que el límite ya se excede
+                if self.max_campo and self._disponible() > self.max_campo + self.tamano_bloque:
+                    raise LimiteEnvioExcedido(f"El campo '{clave}' supera el tamaño máximo de {self.max_campo} bytes")
+                requerido = max(2 * self._disponible(), self.tamano_bloque)
+            self._leer_bloque()
+
+    def pares(self):
+        """
+        Genera (clave, valor) por cada miembro del objeto, a medida que se leen.
+        """
+        if self._caracter() != '{':
+            raise ValueError("Se esperaba un objeto JSON")
+        self.pos += 1
+        if self._caracter() == '}':
+            self.pos += 1
+            return
+
+        while True:
+            if self._caracter() != '"':
+                raise ValueError("Se esperaba una clave entre comillas")
+            clave = self._valor()
+            if self._caracter() != ':':
+                raise ValueError(f"Se esperaba ':' después de '{clave}'")
+            self.pos += 1
+            yield clave, self._valor(clave)
+
+            separador = self._caracter()
+            self.pos += 1
+            if separador == '}':
+                return
+            if separador != ',':
+                raise ValueError(f"Se esperaba ',' o '}}' después de '{clave}'")
+
+
+def directorio_archivados():
+    return getattr(settings, 'CUSTOM_FORMS_ARCHIVOS_DIR', 'custom_forms/valores/')
+
+
+def archivar_grandes(valor, umbral, creados):
+    """
+    Reemplaza recursivamente los textos de más de `umbral` caracteres por referencias a default_storage.
+    Cada texto se guarda con un nombre único (no se comparte entre envíos, aunque el contenido sea igual),
+    así que descartar los archivos de un envío fallido no afecta a otros; los nombres se agregan a `creados`.
+    """
+    if isinstance(valor, str):
+        if len(valor) <= umbral:
+            return valor
+        nombre = default_storage.save(f"{directorio_archivados()}{uuid.uuid4().hex}.txt", ContentFile(valor.encode('utf-8')))
+        creados.append(nombre)
+        return PREFIJO_ARCHIVADO + nombre
+    if isinstance(valor, list):
+        return [archivar_grandes(v, umbral, creados) for v in valor]
+    if isinstance(valor, dict):
+        return {k: archivar_grandes(v, umbral, creados) for k, v in valor.items()}
+    return valor
+
+
+def resolver_archivados(valor):
+    """
+    Reemplaza recursivamente las referencias de archivar_grandes por el texto original.
+    """
+    if isinstance(valor, str):
+        if not valor.startswith(PREFIJO_ARCHIVADO):
+            return valor
+        try:
+            with default_storage.open(valor[len(PREFIJO_ARCHIVADO):]) as f:
+                return f.read().decode('utf-8')
+        except OSError:
+            return valor  # Archivo eliminado: se conserva la referencia
+    if isinstance(valor, list):
+        return [resolver_archivados(v) for v in valor]
+    if isinstance(valor, dict):
+        return {k: resolver_archivados(v) for k, v in valor.items()}
+    return valor
+
+
+def es_cuerpo_json(request):
+    return request.content_type == 'application/json'
+
+
+class EnvioJSON:
+    """
+    Respuestas de un envío leídas como pares (clave, valor), del cuerpo JSON de la petición o del
+    campo `respuestas` del formulario, aplicando los límites y archivando los textos grandes.
+    """
+    def __init__(self, request, campo='respuestas'):
+        self.request = request
+        self.campo = campo
+        self.creados = []
+
+    def pares(self):
+        if es_cuerpo_json(self.request):
+            flujo = self.request  # HttpRequest.read() lee el cuerpo sin cargarlo completo
+        else:
+            texto = self.request.POST.get(self.campo)
+            if texto is None:
+                raise ValueError("No se recibieron respuestas")
+            flujo = io.StringIO(texto)
+
+        lector = LectorObjetoJSON(
+            flujo,
+            max_envio=getattr(settings, 'CUSTOM_FORMS_MAX_ENVIO_BYTES', 20 * 1024 * 1024),
+            max_campo=getattr(settings, 'CUSTOM_FORMS_MAX_CAMPO_BYTES', 10 * 1024 * 1024),
+        )
+        umbral = getattr(settings, 'CUSTOM_FORMS_ARCHIVAR_DESDE_BYTES', 256 * 1024)
+        for clave, valor in lector.pares():
+            yield clave, archivar_grandes(valor, umbral, self.creados)
+
+    def descartar_archivados(self):
+        """
+        Elimina los archivos creados por este envío (p. ej. si la transacción que lo guardaba falló).
+        Ninguna otra respuesta puede referenciarlos: los nombres son únicos por envío.
+        """
+        for nombre in self.creados:
+            default_storage.delete(nombre)
+        self.creados = []
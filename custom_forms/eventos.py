@@ -0,0 +1,116 @@
+"""
+Entrega por lotes de los eventos del outbox (EventoSalida) a destinos intercambiables.
+
+Destinos incluidos: webhook HTTP, archivo JSON Lines y señal de Django. Se puede usar
+uno propio con una clase que implemente `enviar(eventos)` y su ruta en
+CUSTOM_FORMS_OUTBOX_DESTINO (o con `despachar_eventos --destino ruta.a.Clase`).
+"""
+import json
+from datetime import timedelta
+from urllib import request as urllib_request
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.dispatch import Signal
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import EventoSalida
+
+# Se emite con `eventos` (lista de dicts) por cada lote entregado con SenalDestino
+eventos_despachados = Signal()
+
+
+class DestinoEventos:
+    def enviar(self, eventos):
+        """Entrega una lista de eventos (dicts). Debe lanzar una excepción si la entrega falla."""
+        raise NotImplementedError
+
+
+class WebhookDestino(DestinoEventos):
+    def __init__(self, url, timeout=10, cabeceras=None):
+        self.url = url
+        self.timeout = timeout
+        self.cabeceras = cabeceras or {}
+
+    def enviar(self, eventos):
+        cuerpo = json.dumps({'eventos': eventos}).encode('utf-8')
+        peticion = urllib_request.Request(
+            self.url, data=cuerpo, method='POST',
+            headers={'Content-Type': 'application/json', **self.cabeceras}
+        )
+        # urlopen lanza HTTPError para respuestas 4xx/5xx
+        with urllib_request.urlopen(peticion, timeout=self.timeout) as respuesta:
+            respuesta.read()
+
+
+class ArchivoDestino(DestinoEventos):
+    def __init__(self, ruta):
+        self.ruta = ruta
+
+    def enviar(self, eventos):
+        with open(self.ruta, 'a', encoding='utf-8') as archivo:
+            for evento in eventos:
+                archivo.write(json.dumps(evento) + '\n')
+
+
+class SenalDestino(DestinoEventos):
+    def enviar(self, eventos):
+        eventos_despachados.send(sender=EventoSalida, eventos=eventos)
+
+
+DESTINOS = {
+    'webhook': WebhookDestino,
+    'archivo': ArchivoDestino,
+    'senal': SenalDestino,
+}
+
+
+def obtener_destino(nombre=None, **opciones):
+    """
+    Instancia un destino por nombre ('webhook', 'archivo', 'senal') o ruta de clase.
+    Por defecto usa CUSTOM_FORMS_OUTBOX_DESTINO y CUSTOM_FORMS_OUTBOX_OPCIONES.
+    """
+    nombre = nombre or getattr(settings, 'CUSTOM_FORMS_OUTBOX_DESTINO', 'senal')
+    if not opciones:
+        opciones = getattr(settings, 'CUSTOM_FORMS_OUTBOX_OPCIONES', {})
+    clase = DESTINOS.get(nombre) or import_string(nombre)
+    return clase(**opciones)
+
+
+def despachar_lote(destino, tamano_lote=100, max_intentos=8, espera_base=2, espera_maxima=3600):
+    """
+    Toma un lote de eventos pendientes (bloqueándolos con SKIP LOCKED cuando la base lo soporta,
+    para permitir varios despachadores) y lo entrega al destino. Si la entrega falla se
+    reprograma con backoff exponencial y, tras `max_intentos`, el evento queda como fallido.
+    Retorna (enviados, fallidos_en_este_lote).
+    """
+    ahora = timezone.now()
+    with transaction.atomic():
+        eventos = list(
+            EventoSalida.objects
+            .select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+            .filter(estado=EventoSalida.PENDIENTE, proximo_intento__lte=ahora)
+            .order_by('id')[:tamano_lote]
+        )
+        if not eventos:
+            return 0, 0
+
+        try:
+            destino.enviar([evento.a_dict() for evento in eventos])
+        except Exception as e:
+            for evento in eventos:
+                evento.intentos += 1
+                evento.ultimo_error = str(e)[:2000]
+                if evento.intentos >= max_intentos:
+                    evento.estado = EventoSalida.FALLIDO
+                else:
+                    espera = min(espera_base ** evento.intentos, espera_maxima)
+                    evento.proximo_intento = ahora + timedelta(seconds=espera)
+            EventoSalida.objects.bulk_update(eventos, ['intentos', 'ultimo_error', 'estado', 'proximo_intento'])
+            return 0, len(eventos)
+
+        EventoSalida.objects.filter(pk__in=[evento.pk for evento in eventos]).update(
+            estado=EventoSalida.ENVIADO, enviado_en=timezone.now(), ultimo_error=''
+        )
+        return len(eventos), 0
@@ -8,9 +8,11 @@ from .models import Formulario, Encuesta
 class FormularioForm(ModelBaseForm):
     class Meta:
         model = Formulario
-        fields = ['nombre']
+        fields = ['nombre', 'almacenamiento', 'limpiar_ocultos']
         labels = {
             'nombre': 'Nombre del Formulario',
+            'almacenamiento': 'Almacenamiento de Respuestas',
+            'limpiar_ocultos': 'Descartar Respuestas de Campos Ocultos',
         }
 
 
@@ -25,9 +27,14 @@ class EncuestaForm(ModelBaseForm):
             'activa': 'Encuesta Activa',
             'fecha_inicio': 'Fecha de Inicio',
             'fecha_fin': 'Fecha de Fin',
+            'estadisticas_aproximadas': 'Estadísticas Aproximadas (encuestas muy grandes)',
         }
-        exclude = ['creada_por', 'creada_en']
+        exclude = ['creada_por', 'creada_en', 'eliminacion_pendiente', 'total_respuestas', 'ultima_respuesta']
         widgets = {
             'fecha_inicio': forms.DateInput(attrs={'type': 'date'}),
             'fecha_fin': forms.DateInput(attrs={'type': 'date'}),
-        }
\ No newline at end of file
+        }
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['formulario'].queryset = Formulario.objects.filter(eliminacion_pendiente=False)
\ No newline at end of file
@@ -0,0 +1,130 @@
+import copy
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from custom_forms.models import Formulario, FormularioVersion, CampoDefinido, RespuestaEncuesta, CampoRespuesta, Encuesta
+from custom_forms.utils import clave_campo_definido, invalidar_schema_version
+
+
+def _aplicar_etiquetas(componentes, etiquetas):
+    for comp in componentes:
+        if comp.get('key') in etiquetas:
+            comp['label'] = etiquetas[comp['key']]
+        for anidados in ('components', 'columns', 'rows'):
+            hijos = comp.get(anidados)
+            if isinstance(hijos, list):
+                for hijo in hijos:
+                    if isinstance(hijo, dict):
+                        _aplicar_etiquetas([hijo], etiquetas)
+                    elif isinstance(hijo, list):
+                        _aplicar_etiquetas([c for c in hijo if isinstance(c, dict)], etiquetas)
+
+
+class Command(BaseCommand):
+    help = (
+        "Prepara la eliminación de las columnas clave/etiqueta de CampoRespuesta: repara filas cuya "
+        "clave copiada no coincide con su CampoDefinido y crea el FormularioVersion de cada versión "
+        "respondida, para que las etiquetas históricas se resuelvan desde el schema. "
+        "Ejecutar antes de aplicar la migración que elimina las columnas."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=5000, help="Filas de CampoRespuesta leídas por consulta")
+
+    def handle(self, *args, **options):
+        tabla = CampoRespuesta._meta.db_table
+        with connection.cursor() as cursor:
+            columnas = {c.name for c in connection.introspection.get_table_description(cursor, tabla)}
+        legado = {'clave', 'etiqueta'} <= columnas
+
+        if legado:
+            self.reparar_claves(tabla, options['lote'])
+        else:
+            self.stdout.write("Las columnas clave/etiqueta ya no existen; solo se completan las versiones")
+
+        self.completar_versiones(tabla if legado else None)
+        self.stdout.write(self.style.SUCCESS("Compactación completada"))
+
+    def reparar_claves(self, tabla, lote):
+        """
+        Recorre CampoRespuesta por rangos de id comparando la clave copiada con la de su CampoDefinido.
+        """
+        q = connection.ops.quote_name
+        sql = (
+            f"SELECT {q('id')}, {q('campo_definido_id')}, {q('clave')} FROM {q(tabla)} "
+            f"WHERE {q('id')} > %s ORDER BY {q('id')} LIMIT %s"
+        )
+        ultimo_id, revisadas, reparadas, sin_campo = 0, 0, 0, 0
+        while True:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [ultimo_id, lote])
+                filas = cursor.fetchall()
+            if not filas:
+                break
+            ultimo_id = filas[-1][0]
+            revisadas += len(filas)
+
+            for campo_id, campo_definido_id, clave_legada in filas:
+                if clave_campo_definido(campo_definido_id) == clave_legada:
+                    continue
+                destino = CampoDefinido.objects.filter(
+                    formulario__campodefinido__id=campo_definido_id, clave=clave_legada
+                ).values_list('id', flat=True).first()
+                if destino is None:
+                    sin_campo += 1
+                    self.stdout.write(self.style.WARNING(
+                        f"  CampoRespuesta {campo_id}: la clave '{clave_legada}' no existe en el formulario"
+                    ))
+                    continue
+                CampoRespuesta.objects.filter(pk=campo_id).update(campo_definido_id=destino)
+                reparadas += 1
+
+            self.stdout.write(f"  {revisadas} filas revisadas (hasta id {ultimo_id})")
+
+        self.stdout.write(f"{reparadas} filas reasignadas a su CampoDefinido, {sin_campo} sin campo equivalente")
+
+    def completar_versiones(self, tabla_legada):
+        """
+        Crea un FormularioVersion para cada versión con respuestas que no lo tenga. La versión actual
+        copia Formulario.json; para versiones anteriores sin copia se usa el schema actual con las
+        etiquetas que quedaron guardadas en las filas (si las columnas todavía existen).
+        """
+        creadas, sin_etiquetas = 0, 0
+        for formulario in Formulario.objects.only('id', 'json', 'version').iterator():
+            respondidas = set(
+                RespuestaEncuesta.objects.filter(encuesta__formulario=formulario)
+                .order_by().values_list('version', flat=True).distinct()
+            )
+            existentes = set(FormularioVersion.objects.filter(formulario=formulario).values_list('numero', flat=True))
+
+            for numero in sorted(respondidas - existentes):
+                schema = copy.deepcopy(formulario.json)
+                if numero != formulario.version:
+                    if tabla_legada is None:
+                        sin_etiquetas += 1
+                        self.stdout.write(self.style.WARNING(
+                            f"  {formulario} v{numero}: sin schema guardado, se usará el actual"
+                        ))
+                    else:
+                        _aplicar_etiquetas(schema.get('components', []), self.etiquetas_legadas(tabla_legada, formulario.id, numero))
+
+                FormularioVersion.objects.get_or_create(formulario=formulario, numero=numero, defaults={'json': schema})
+                invalidar_schema_version(formulario.id, [numero])
+                creadas += 1
+
+        self.stdout.write(f"{creadas} versiones de formulario creadas, {sin_etiquetas} sin etiquetas históricas")
+
+    def etiquetas_legadas(self, tabla, formulario_id, numero):
+        q = connection.ops.quote_name
+        tabla_respuesta = RespuestaEncuesta._meta.db_table
+        tabla_encuesta = Encuesta._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT DISTINCT cr.{q('clave')}, cr.{q('etiqueta')} FROM {q(tabla)} cr "
+                f"JOIN {q(tabla_respuesta)} r ON r.{q('id')} = cr.{q('respuesta_id')} "
+                f"JOIN {q(tabla_encuesta)} e ON e.{q('id')} = r.{q('encuesta_id')} "
+                f"WHERE e.{q('formulario_id')} = %s AND r.{q('version')} = %s AND cr.{q('etiqueta')} <> ''",
+                [formulario_id, numero]
+            )
+            return dict(cursor.fetchall())
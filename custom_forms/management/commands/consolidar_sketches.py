@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from custom_forms.utils import consolidar_sketches
+
+
+class Command(BaseCommand):
+    help = "Agrega por lotes a los SketchCampo los valores de los envíos pendientes (SketchPendiente)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help="Envíos pendientes agregados por transacción")
+        parser.add_argument('--continuo', action='store_true', help="Seguir consolidando hasta interrumpir")
+        parser.add_argument('--intervalo', type=float, default=30, help="Segundos de espera sin pendientes (modo continuo)")
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            agregados = consolidar_sketches(options['lote'])
+            total += agregados
+            if not agregados:
+                if not options['continuo']:
+                    break
+                time.sleep(options['intervalo'])
+
+        self.stdout.write(self.style.SUCCESS(f"{total} envíos agregados a los resúmenes"))
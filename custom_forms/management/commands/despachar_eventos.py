@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from custom_forms.eventos import obtener_destino, despachar_lote
+
+
+class Command(BaseCommand):
+    help = "Entrega por lotes los eventos pendientes del outbox (webhook, archivo o señal), con reintentos y backoff."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--destino', help="webhook, archivo, senal o ruta de una clase (por defecto CUSTOM_FORMS_OUTBOX_DESTINO)")
+        parser.add_argument('--url', help="URL del webhook")
+        parser.add_argument('--archivo', help="Ruta del archivo JSON Lines")
+        parser.add_argument('--lote', type=int, default=100)
+        parser.add_argument('--max-intentos', type=int, default=8)
+        parser.add_argument('--continuo', action='store_true', help="Seguir despachando hasta interrumpir")
+        parser.add_argument('--intervalo', type=float, default=5, help="Segundos de espera sin eventos (modo continuo)")
+
+    def handle(self, *args, **options):
+        opciones = {}
+        if options['url']:
+            opciones['url'] = options['url']
+        if options['archivo']:
+            opciones['ruta'] = options['archivo']
+        destino = obtener_destino(options['destino'], **opciones)
+
+        total_enviados = total_fallidos = 0
+        while True:
+            enviados, fallidos = despachar_lote(destino, options['lote'], options['max_intentos'])
+            total_enviados += enviados
+            total_fallidos += fallidos
+            if fallidos:
+                self.stdout.write(self.style.WARNING(f"Lote de {fallidos} eventos no entregado; se reintentará"))
+
+            if not enviados and not fallidos:
+                if not options['continuo']:
+                    break
+                time.sleep(options['intervalo'])
+            elif fallidos and not options['continuo']:
+                break
+
+        self.stdout.write(self.style.SUCCESS(f"{total_enviados} eventos entregados, {total_fallidos} con error"))
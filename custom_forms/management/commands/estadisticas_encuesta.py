@@ -0,0 +1,46 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from custom_forms.models import Encuesta
+from custom_forms.paralelo import estadisticas_encuesta
+
+
+class Command(BaseCommand):
+    help = (
+        "Calcula estadísticas exactas por campo de una encuesta (conteo, media, desviación, mínimo, máximo "
+        "y valores más frecuentes) en paralelo por rangos de id, combinando los agregados parciales."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('encuesta', type=int)
+        parser.add_argument('--procesos', type=int, default=0, help="Procesos del pool (0 = núcleos disponibles)")
+        parser.add_argument('--respuestas-por-rango', type=int, default=50000)
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas leídas por consulta")
+        parser.add_argument('--json', action='store_true', help="Imprimir el resultado como JSON")
+
+    def handle(self, *args, **options):
+        try:
+            encuesta = Encuesta.objects.get(pk=options['encuesta'])
+        except Encuesta.DoesNotExist:
+            raise CommandError(f"No existe la encuesta {options['encuesta']}")
+
+        estadisticas = estadisticas_encuesta(
+            encuesta, options['procesos'], options['respuestas_por_rango'], options['lote']
+        )
+
+        if options['json']:
+            self.stdout.write(json.dumps(estadisticas, cls=DjangoJSONEncoder, ensure_ascii=False, indent=2))
+            return
+
+        self.stdout.write(f"{encuesta}: {estadisticas['respuestas']} respuestas")
+        for clave, resumen in estadisticas['campos'].items():
+            linea = f"  {resumen['etiqueta']} ({clave}, {resumen['tipo']}): {resumen['conteo']} respondidas"
+            if 'media' in resumen:
+                linea += f", media {resumen['media']:.4g}, desviación {resumen['desviacion']:.4g}"
+            if resumen['minimo'] is not None:
+                linea += f", mín {resumen['minimo']}, máx {resumen['maximo']}"
+            self.stdout.write(linea)
+            for valor, conteo in resumen.get('frecuentes', []):
+                self.stdout.write(f"      {valor}: {conteo}")
@@ -0,0 +1,73 @@
+import csv, os, shutil
+
+from django.core.management.base import BaseCommand, CommandError
+
+from custom_forms.models import Encuesta, CampoDefinido
+from custom_forms.paralelo import rangos_respuestas, ejecutar_en_paralelo
+from custom_forms.utils import camel_to_snake, iterar_filas_tipadas, sin_zona
+
+
+def exportar_rango(encuesta, campos, ruta, desde_id, hasta_id, tamano_lote):
+    """
+    Escribe en `ruta` (sin encabezado) las respuestas con id en (desde_id, hasta_id]. Se ejecuta en un proceso del pool.
+    """
+    total = 0
+    with open(ruta, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        for respuesta, valores in iterar_filas_tipadas(encuesta, campos, desde_id, hasta_id, tamano_lote):
+            writer.writerow(
+                [respuesta.id, sin_zona(respuesta.enviado), respuesta.version] +
+                [sin_zona(valores.get(campo.clave)) for campo in campos]
+            )
+            total += 1
+    return total
+
+
+class Command(BaseCommand):
+    help = (
+        "Exporta a CSV las respuestas tipadas de una encuesta. Las respuestas se dividen en rangos de id "
+        "que se exportan en paralelo a archivos parciales y se unen en orden de id."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('encuesta', type=int)
+        parser.add_argument('destino', help="Archivo CSV de salida")
+        parser.add_argument('--procesos', type=int, default=0, help="Procesos del pool (0 = núcleos disponibles)")
+        parser.add_argument('--respuestas-por-rango', type=int, default=50000)
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas leídas por consulta")
+
+    def handle(self, *args, **options):
+        try:
+            encuesta = Encuesta.objects.select_related('formulario').get(pk=options['encuesta'])
+        except Encuesta.DoesNotExist:
+            raise CommandError(f"No existe la encuesta {options['encuesta']}")
+
+        campos = list(CampoDefinido.objects.filter(formulario=encuesta.formulario, activo=True).order_by('id'))
+        rangos = rangos_respuestas(encuesta, options['respuestas_por_rango'])
+        destino = options['destino']
+        parciales = [f"{destino}.parte-{i:05d}" for i in range(len(rangos))]
+        tareas = [
+            (encuesta, campos, ruta, desde, hasta, options['lote'])
+            for ruta, (desde, hasta) in zip(parciales, rangos)
+        ]
+
+        total = 0
+        try:
+            for ruta, escritas in zip(parciales, ejecutar_en_paralelo(exportar_rango, tareas, options['procesos'])):
+                total += escritas
+                self.stdout.write(f"  {ruta}: {escritas} respuestas")
+
+            # Unión en el orden de los rangos: el archivo final no depende del número de procesos
+            temporal = destino + '.tmp'
+            with open(temporal, 'w', newline='', encoding='utf-8') as salida:
+                csv.writer(salida).writerow(['respuesta_id', 'enviado', 'version'] + [camel_to_snake(c.clave) for c in campos])
+                for ruta in parciales:
+                    with open(ruta, encoding='utf-8') as parcial:
+                        shutil.copyfileobj(parcial, salida)
+            os.replace(temporal, destino)
+        finally:
+            for ruta in parciales:
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+
+        self.stdout.write(self.style.SUCCESS(f"{total} respuestas exportadas a {destino}"))
@@ -0,0 +1,214 @@
+import json, random, time, uuid
+import multiprocessing
+from datetime import date, datetime, timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client
+
+from custom_forms.models import Encuesta, RespuestaEncuesta
+from custom_forms.utils import extraer_componentes
+
+
+ACCIONES = ('responder', 'editar', 'resultados')
+
+
+def _valor_sintetico(comp, rnd):
+    """
+    Genera un valor plausible para un componente Formio según su tipo y sus opciones.
+    """
+    tipo = comp.get('type')
+    opciones = [v.get('value') for v in comp.get('values') or [] if isinstance(v, dict) and 'value' in v]
+
+    if tipo in ('number', 'currency'):
+        return round(rnd.uniform(0, 1000), 2)
+    if tipo == 'checkbox':
+        return rnd.random() < 0.5
+    if tipo in ('select', 'radio'):
+        return rnd.choice(opciones) if opciones else f"opcion_{rnd.randint(1, 5)}"
+    if tipo == 'selectboxes':
+        return {opcion: rnd.random() < 0.5 for opcion in opciones}
+    if tipo == 'day':
+        return (date(2020, 1, 1) + timedelta(days=rnd.randint(0, 2000))).isoformat()
+    if tipo == 'time':
+        return f"{rnd.randint(0, 23):02d}:{rnd.randint(0, 59):02d}:00"
+    if tipo == 'datetime':
+        return (datetime(2020, 1, 1) + timedelta(minutes=rnd.randint(0, 3_000_000))).isoformat()
+    if tipo in ('datagrid', 'editgrid'):
+        return [
+            {sub['key']: _valor_sintetico(sub, rnd) for sub in comp.get('values') or [] if sub.get('key')}
+            for _ in range(rnd.randint(1, 5))
+        ]
+    if tipo == 'email':
+        return f"usuario{rnd.randint(1, 100000)}@example.com"
+    if tipo == 'textarea':
+        return ' '.join(f"palabra{rnd.randint(1, 500)}" for _ in range(rnd.randint(5, 60)))
+    return f"texto {rnd.randint(1, 100000)}"
+
+
+def generar_respuestas_sinteticas(componentes, rnd):
+    return {comp['key']: _valor_sintetico(comp, rnd) for comp in componentes if comp.get('key')}
+
+
+def _percentil(ordenados, p):
+    if not ordenados:
+        return 0.0
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def _trabajador(indice, config, cola):
+    """
+    Proceso de carga: su propio Client (sesión autenticada) y su propia conexión a la base de datos.
+    """
+    resultados = {accion: {'latencias': [], 'errores': 0, 'estados': {}} for accion in ACCIONES}
+    try:
+        rnd = random.Random(config['semilla'] + indice)
+        cliente = Client(HTTP_HOST=config['host'])
+        cliente.raise_request_exception = False  # Los errores 500 se cuentan, no detienen la prueba
+        cliente.force_login(get_user_model().objects.get(pk=config['usuario_id']))
+
+        ruta = config['ruta']
+        encuesta_id = config['encuesta_id']
+        ids_respuestas = list(config['ids_respuestas'])
+        acciones = [accion for accion, peso in config['mezcla'].items() if peso > 0]
+        pesos = [config['mezcla'][accion] for accion in acciones]
+
+        for _ in range(config['peticiones']):
+            accion = rnd.choices(acciones, pesos)[0]
+            if accion == 'editar' and not ids_respuestas:
+                accion = 'responder'
+
+            inicio = time.perf_counter()
+            try:
+                if accion == 'responder':
+                    respuesta = cliente.post(ruta, {
+                        'action': 'responder_encuesta',
+                        'id': encuesta_id,
+                        'clave_envio': uuid.uuid4().hex,
+                        'respuestas': json.dumps(generar_respuestas_sinteticas(config['componentes'], rnd)),
+                    })
+                elif accion == 'editar':
+                    respuesta = cliente.post(ruta, {
+                        'action': 'edit_resultado',
+                        'id_respuesta': rnd.choice(ids_respuestas),
+                        'clave_envio': uuid.uuid4().hex,
+                        'respuestas': json.dumps(generar_respuestas_sinteticas(config['componentes'], rnd)),
+                    })
+                else:
+                    respuesta = cliente.get(ruta, {
+                        'action': 'resultados', 'id': encuesta_id, 'page': rnd.randint(1, config['paginas']),
+                    })
+                estado = respuesta.status_code
+            except Exception as e:
+                estado = type(e).__name__
+            transcurrido = time.perf_counter() - inicio
+
+            datos = resultados[accion]
+            datos['latencias'].append(transcurrido)
+            datos['estados'][str(estado)] = datos['estados'].get(str(estado), 0) + 1
+            if not isinstance(estado, int) or estado >= 400:
+                datos['errores'] += 1
+
+    except Exception as e:
+        resultados['fallo'] = f"Proceso {indice}: {e!r}"  # Sin esto el proceso principal esperaría indefinidamente
+    finally:
+        connections.close_all()
+        cola.put(resultados)
+
+
+class Command(BaseCommand):
+    help = (
+        "Prueba de carga: varios procesos envían, editan y consultan respuestas de una encuesta en paralelo "
+        "a través de EncuestaAdminView (sin servidor HTTP ni red) y reportan rendimiento, latencias "
+        "p50/p95/p99 y tasa de errores por acción. Usar con --settings apuntando a una base de datos local."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('encuesta', type=int)
+        parser.add_argument('--procesos', type=int, default=4)
+        parser.add_argument('--peticiones', type=int, default=200, help="Peticiones por proceso")
+        parser.add_argument('--mezcla', default='responder=8,editar=1,resultados=1',
+                            help="Pesos por acción, p. ej. responder=8,editar=1,resultados=1")
+        parser.add_argument('--usuario', help="Username del usuario autenticado (por defecto el primer superusuario)")
+        parser.add_argument('--ruta', default='/encuestas/', help="Ruta donde está montada EncuestaAdminView")
+        parser.add_argument('--host', default='localhost', help="Cabecera Host (debe estar en ALLOWED_HOSTS)")
+        parser.add_argument('--semilla', type=int, default=0)
+
+    def handle(self, *args, **options):
+        encuesta = Encuesta.objects.select_related('formulario').get(pk=options['encuesta'])
+
+        try:
+            mezcla = {accion: float(peso) for accion, peso in (p.split('=') for p in options['mezcla'].split(','))}
+        except ValueError:
+            raise CommandError("--mezcla debe tener el formato accion=peso,accion=peso")
+        if set(mezcla) - set(ACCIONES):
+            raise CommandError(f"Acciones válidas: {', '.join(ACCIONES)}")
+
+        Usuario = get_user_model()
+        if options['usuario']:
+            usuario = Usuario.objects.get(**{Usuario.USERNAME_FIELD: options['usuario']})
+        else:
+            usuario = Usuario.objects.filter(is_superuser=True).order_by('pk').first()
+            if usuario is None:
+                raise CommandError("No hay superusuarios; indique --usuario")
+
+        componentes = [c for c in extraer_componentes(encuesta.formulario.json) if c.get('type') not in ('file', 'signature')]
+        ids_respuestas = list(
+            RespuestaEncuesta.objects.filter(encuesta=encuesta).order_by('-id').values_list('id', flat=True)[:1000]
+        )
+        config = {
+            'encuesta_id': encuesta.pk,
+            'usuario_id': usuario.pk,
+            'componentes': componentes,
+            'ids_respuestas': ids_respuestas,
+            'mezcla': mezcla,
+            'peticiones': options['peticiones'],
+            'paginas': max(1, len(ids_respuestas) // 50),
+            'ruta': options['ruta'],
+            'host': options['host'],
+            'semilla': options['semilla'],
+        }
+
+        # Cada proceso hijo debe abrir su propia conexión: no se comparten sockets a través de fork
+        connections.close_all()
+        contexto = multiprocessing.get_context('fork')
+        cola = contexto.Queue()
+        procesos = [contexto.Process(target=_trabajador, args=(i, config, cola)) for i in range(options['procesos'])]
+
+        self.stdout.write(
+            f"{options['procesos']} procesos x {options['peticiones']} peticiones contra '{encuesta}' "
+            f"({len(componentes)} campos por envío)"
+        )
+        inicio = time.perf_counter()
+        for proceso in procesos:
+            proceso.start()
+        parciales = [cola.get() for _ in procesos]
+        for proceso in procesos:
+            proceso.join()
+        duracion = time.perf_counter() - inicio
+
+        self.reportar(parciales, duracion)
+
+    def reportar(self, parciales, duracion):
+        for parcial in parciales:
+            if 'fallo' in parcial:
+                self.stdout.write(self.style.ERROR(parcial['fallo']))
+        self.stdout.write(f"Duración total: {duracion:.2f}s")
+        self.stdout.write(f"{'acción':<12}{'total':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errores':>10}")
+        for accion in ACCIONES:
+            latencias = sorted(l for parcial in parciales for l in parcial[accion]['latencias'])
+            if not latencias:
+                continue
+            errores = sum(parcial[accion]['errores'] for parcial in parciales)
+            self.stdout.write(
+                f"{accion:<12}{len(latencias):>8}{len(latencias) / duracion:>10.1f}"
+                f"{_percentil(latencias, 50) * 1000:>10.1f}{_percentil(latencias, 95) * 1000:>10.1f}"
+                f"{_percentil(latencias, 99) * 1000:>10.1f}{errores / len(latencias):>9.1%}"
+            )
+            if errores:
+                estados = {}
+                for parcial in parciales:
+                    for estado, total in parcial[accion]['estados'].items():
+                        estados[estado] = estados.get(estado, 0) + total
+                self.stdout.write(self.style.WARNING(f"  estados: {estados}"))
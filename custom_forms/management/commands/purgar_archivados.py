@@ -0,0 +1,23 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from custom_forms.utils import purgar_archivados
+
+
+class Command(BaseCommand):
+    help = (
+        "Elimina de default_storage los textos archivados de envíos grandes que ya no referencia ninguna "
+        "respuesta (envíos fallidos, valores reemplazados al editar, respuestas purgadas)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--horas', type=float, default=24, help="Antigüedad mínima de los archivos a eliminar")
+        parser.add_argument('--simular', action='store_true', help="Listar los archivos sin eliminarlos")
+
+    def handle(self, *args, **options):
+        eliminados = purgar_archivados(timedelta(hours=options['horas']), options['simular'])
+        for nombre in eliminados:
+            self.stdout.write(f"  {nombre}")
+        accion = "se eliminarían" if options['simular'] else "eliminados"
+        self.stdout.write(self.style.SUCCESS(f"{len(eliminados)} archivos {accion}"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from custom_forms.models import Formulario, Encuesta
+from custom_forms.utils import eliminar_encuesta_por_lotes, eliminar_formulario_por_lotes
+
+
+class Command(BaseCommand):
+    help = "Elimina por lotes las encuestas y formularios marcados con eliminacion_pendiente."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas eliminadas por transacción")
+
+    def handle(self, *args, **options):
+        lote = options['lote']
+
+        def progreso(encuesta, eliminadas, total):
+            self.stdout.write(f"  Encuesta {encuesta.pk}: {eliminadas}/{total} respuestas eliminadas")
+
+        for encuesta in Encuesta.objects.filter(eliminacion_pendiente=True, formulario__eliminacion_pendiente=False):
+            self.stdout.write(f"Eliminando encuesta {encuesta.pk} ({encuesta})")
+            eliminar_encuesta_por_lotes(encuesta, lote, progreso)
+
+        for formulario in Formulario.objects.filter(eliminacion_pendiente=True):
+            self.stdout.write(f"Eliminando formulario {formulario.pk} ({formulario})")
+            eliminar_formulario_por_lotes(formulario, lote, progreso)
+
+        self.stdout.write(self.style.SUCCESS("Purga completada"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from custom_forms.models import Encuesta
+from custom_forms.utils import recalcular_contadores_encuestas
+
+
+class Command(BaseCommand):
+    help = "Recalcula los contadores cacheados de respuestas de las encuestas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--encuesta', type=int, action='append', help="Limitar a estas encuestas (repetible)")
+
+    def handle(self, *args, **options):
+        encuestas = None
+        if options['encuesta']:
+            encuestas = Encuesta.objects.filter(pk__in=options['encuesta'])
+
+        total = recalcular_contadores_encuestas(encuestas)
+        self.stdout.write(self.style.SUCCESS(f"Contadores recalculados en {total} encuestas"))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from custom_forms.models import Encuesta
+from custom_forms.utils import reconstruir_resumen_envios
+
+
+class Command(BaseCommand):
+    help = "Reconstruye el resumen de envíos por hora desde RespuestaEncuesta."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--encuesta', type=int, action='append', help="Limitar a estas encuestas (repetible)")
+
+    def handle(self, *args, **options):
+        encuestas = None
+        if options['encuesta']:
+            encuestas = Encuesta.objects.filter(pk__in=options['encuesta'])
+
+        filas = reconstruir_resumen_envios(encuestas)
+        self.stdout.write(self.style.SUCCESS(f"Resumen reconstruido: {filas} intervalos"))
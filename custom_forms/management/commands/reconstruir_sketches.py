@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from custom_forms.models import Encuesta
+from custom_forms.utils import reconstruir_sketches
+
+
+class Command(BaseCommand):
+    help = "Recalcula los resúmenes aproximados (SketchCampo) de las encuestas con estadísticas aproximadas."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--encuesta', type=int, action='append', help="Limitar a estas encuestas (repetible)")
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas leídas por consulta")
+
+    def handle(self, *args, **options):
+        encuestas = Encuesta.objects.filter(estadisticas_aproximadas=True)
+        if options['encuesta']:
+            encuestas = encuestas.filter(pk__in=options['encuesta'])
+
+        for encuesta in encuestas:
+            self.stdout.write(f"Reconstruyendo resúmenes de {encuesta}")
+            reconstruir_sketches(encuesta, options['lote'])
+
+        self.stdout.write(self.style.SUCCESS("Resúmenes reconstruidos"))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from custom_forms.models import TareaRetipado
+from custom_forms.utils import ejecutar_tarea_retipado
+
+
+class Command(BaseCommand):
+    help = "Procesa las tareas de re-tipado pendientes creadas al cambiar el tipo de un campo."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas actualizadas por transacción")
+
+    def handle(self, *args, **options):
+        def progreso(tarea, errores):
+            self.stdout.write(f"  {tarea.procesados} respuestas procesadas (hasta id {tarea.ultimo_id})")
+            for error in errores:
+                self.stdout.write(self.style.WARNING(f"  No convertible: CampoRespuesta {error['id']} '{error['valor']}': {error['error']}"))
+
+        for tarea in TareaRetipado.objects.filter(completada=False).select_related('campo_definido').order_by('id'):
+            self.stdout.write(f"Re-tipando {tarea}")
+            ejecutar_tarea_retipado(tarea, options['lote'], progreso=progreso)
+            self.stdout.write(f"  {tarea.no_convertibles} valores no convertibles")
+
+        self.stdout.write(self.style.SUCCESS("Re-tipado completado"))
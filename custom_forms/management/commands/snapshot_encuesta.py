@@ -0,0 +1,201 @@
+import csv, json, os
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from custom_forms.models import Encuesta, CampoDefinido, RespuestaEncuesta
+from custom_forms.paralelo import rangos_respuestas, ejecutar_en_paralelo
+from custom_forms.utils import camel_to_snake, iterar_filas_tipadas, sin_zona
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+COLUMNAS_FIJAS = ('respuesta_id', 'enviado', 'version')
+
+
+def nombres_columnas(campos):
+    """
+    Devuelve [{'nombre', 'clave', 'tipo'}] con un nombre de columna único por CampoDefinido: claves
+    distintas pueden dar el mismo snake_case, o coincidir con las columnas fijas, y no deben pisarse.
+    """
+    usados = set(COLUMNAS_FIJAS)
+    columnas = []
+    for campo in campos:
+        base = camel_to_snake(campo.clave)
+        nombre, sufijo = base, 2
+        if nombre in usados:
+            nombre = f"campo_{base}"
+        while nombre in usados:
+            nombre = f"campo_{base}_{sufijo}"
+            sufijo += 1
+        usados.add(nombre)
+        columnas.append({'nombre': nombre, 'clave': campo.clave, 'tipo': campo.tipo})
+    return columnas
+
+
+def escribir_rango(encuesta, campos, destino, formato, columnas, numero, desde_id, hasta_id, tamano_lote):
+    """
+    Escribe la parte `numero` con las respuestas de id en (desde_id, hasta_id]. Se ejecuta en un
+    proceso del pool; devuelve (filas escritas, id y fecha de la última respuesta).
+    """
+    filas = [
+        (respuesta.id, sin_zona(respuesta.enviado), respuesta.version, valores)
+        for respuesta, valores in iterar_filas_tipadas(encuesta, campos, desde_id, hasta_id, tamano_lote)
+    ]
+    if not filas:
+        return 0, None, None
+
+    datos = {
+        'respuesta_id': [fila[0] for fila in filas],
+        'enviado': [fila[1] for fila in filas],
+        'version': [fila[2] for fila in filas],
+    }
+    for columna in columnas:
+        datos[columna['nombre']] = [sin_zona(fila[3].get(columna['clave'])) for fila in filas]
+
+    nombre = f"parte-{numero:05d}"
+    if formato == 'parquet':
+        pq.write_table(pa.table(datos), os.path.join(destino, f"{nombre}.parquet"))
+    elif formato == 'npy':
+        _escribir_npy(os.path.join(destino, nombre), datos, columnas)
+    else:
+        with open(os.path.join(destino, f"{nombre}.csv"), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(datos.keys()))
+            writer.writerows(zip(*datos.values()))
+
+    return len(filas), filas[-1][0], filas[-1][1]
+
+
+def _escribir_npy(directorio, datos, columnas):
+    """Un .npy por columna (mapeable con np.load(..., mmap_mode='r')); los nulos se codifican como NaN/NaT/-1/''."""
+    os.makedirs(directorio, exist_ok=True)
+    tipos = {columna['nombre']: columna['tipo'] for columna in columnas}
+
+    for nombre, valores in datos.items():
+        tipo = tipos.get(nombre)
+        if nombre in ('respuesta_id', 'version'):
+            arreglo = np.array(valores, dtype=np.int64)
+        elif nombre == 'enviado' or tipo == 'datetime':
+            arreglo = np.array([np.datetime64(v, 'us') if v else np.datetime64('NaT') for v in valores], dtype='datetime64[us]')
+        elif tipo == 'date':
+            arreglo = np.array([np.datetime64(v, 'D') if v else np.datetime64('NaT') for v in valores], dtype='datetime64[D]')
+        elif tipo in ('number', 'time'):
+            arreglo = np.array([np.nan if v is None else v for v in valores], dtype=np.float64)
+        elif tipo == 'boolean':
+            arreglo = np.array([-1 if v is None else int(v) for v in valores], dtype=np.int8)
+        else:
+            arreglo = np.array(['' if v is None else str(v) for v in valores], dtype=str)
+        np.save(os.path.join(directorio, f"{nombre}.npy"), arreglo)
+
+
+class Command(BaseCommand):
+    help = (
+        "Escribe un snapshot columnar de las respuestas tipadas de una encuesta (una columna por CampoDefinido). "
+        "Usa Parquet si pyarrow está instalado, .npy si hay NumPy y CSV en otro caso. "
+        "Las ejecuciones siguientes solo agregan las respuestas posteriores a la marca de agua."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('encuesta', type=int)
+        parser.add_argument('destino', help="Directorio del snapshot")
+        parser.add_argument('--formato', choices=['auto', 'parquet', 'npy', 'csv'], default='auto')
+        parser.add_argument('--filas-por-parte', type=int, default=100000)
+        parser.add_argument('--lote', type=int, default=1000, help="Respuestas leídas por consulta")
+        parser.add_argument('--procesos', type=int, default=1, help="Procesos que escriben partes en paralelo (0 = núcleos)")
+        parser.add_argument(
+            '--margen-segundos', type=int, default=300,
+            help="Solo se incluyen respuestas enviadas antes de este margen (transacciones aún abiertas)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            encuesta = Encuesta.objects.select_related('formulario').get(pk=options['encuesta'])
+        except Encuesta.DoesNotExist:
+            raise CommandError(f"No existe la encuesta {options['encuesta']}")
+
+        destino = os.path.join(options['destino'], f"encuesta_{encuesta.pk}")
+        os.makedirs(destino, exist_ok=True)
+        ruta_metadatos = os.path.join(destino, '_metadatos.json')
+        metadatos = {'encuesta': encuesta.pk, 'formato': None, 'marca_agua': {'id': 0, 'enviado': None}, 'partes': 0, 'columnas': []}
+        if os.path.exists(ruta_metadatos):
+            with open(ruta_metadatos, encoding='utf-8') as f:
+                metadatos = json.load(f)
+
+        formato = metadatos['formato'] or self._resolver_formato(options['formato'])
+        if options['formato'] != 'auto' and options['formato'] != formato:
+            raise CommandError(f"El snapshot existente usa el formato '{formato}'")
+        metadatos['formato'] = formato
+
+        campos = list(CampoDefinido.objects.filter(formulario=encuesta.formulario).order_by('id'))
+        if metadatos['partes']:
+            # Las columnas quedan fijas desde la primera parte: todas las partes comparten el mismo esquema
+            columnas = metadatos['columnas']
+            fijas = {columna['clave'] for columna in columnas}
+            nuevos = [campo.clave for campo in campos if campo.clave not in fijas]
+            if nuevos:
+                self.stdout.write(self.style.WARNING(
+                    f"Campos no incluidos en el snapshot existente: {', '.join(nuevos)}. "
+                    "Genera un snapshot nuevo en otro destino para incluirlos."
+                ))
+            campos = [campo for campo in campos if campo.clave in fijas]
+        else:
+            columnas = nombres_columnas(campos)
+            metadatos['columnas'] = columnas
+
+        # Una parte por rango de id; los rangos se escriben en paralelo y la marca de agua avanza en orden.
+        # Los id se asignan antes de confirmar: una respuesta con id menor puede aparecer después de otra
+        # mayor. El snapshot se detiene antes de la primera respuesta enviada dentro del margen, para que
+        # la marca de agua no salte por encima de transacciones aún abiertas.
+        desde_id = metadatos['marca_agua']['id']
+        corte = timezone.now() - timedelta(seconds=options['margen_segundos'])
+        recientes = RespuestaEncuesta.objects.filter(encuesta=encuesta, id__gt=desde_id, enviado__gte=corte)
+        primera_reciente = recientes.order_by('id').values_list('id', flat=True).first()
+        hasta_id = primera_reciente - 1 if primera_reciente is not None else None
+        rangos = rangos_respuestas(encuesta, options['filas_por_parte'], desde_id=desde_id, hasta_id=hasta_id)
+        primera = metadatos['partes'] + 1
+        tareas = [
+            (encuesta, campos, destino, formato, columnas, primera + i, desde, hasta, options['lote'])
+            for i, (desde, hasta) in enumerate(rangos)
+        ]
+        resultados = ejecutar_en_paralelo(escribir_rango, tareas, options['procesos'])
+        total = 0
+        for numero, (escritas, ultimo_id, ultimo_enviado) in enumerate(resultados, primera):
+            if escritas:
+                total += escritas
+                metadatos['partes'] = numero
+                metadatos['marca_agua'] = {'id': ultimo_id, 'enviado': ultimo_enviado.isoformat() if ultimo_enviado else None}
+                self._guardar_metadatos(ruta_metadatos, metadatos)
+        self._guardar_metadatos(ruta_metadatos, metadatos)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"{total} respuestas agregadas en formato {formato} (marca de agua: id {metadatos['marca_agua']['id']})"
+        ))
+
+    def _resolver_formato(self, formato):
+        if formato == 'parquet' and pa is None:
+            raise CommandError("El formato parquet requiere pyarrow")
+        if formato == 'npy' and np is None:
+            raise CommandError("El formato npy requiere numpy")
+        if formato != 'auto':
+            return formato
+        if pa is not None:
+            return 'parquet'
+        if np is not None:
+            return 'npy'
+        return 'csv'
+
+    def _guardar_metadatos(self, ruta, metadatos):
+        temporal = ruta + '.tmp'
+        with open(temporal, 'w', encoding='utf-8') as f:
+            json.dump(metadatos, f, indent=2)
+        os.replace(temporal, ruta)  # La marca de agua solo avanza si la parte quedó escrita
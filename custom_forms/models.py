@@ -1,6 +1,7 @@
 import json
 
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import Group
 
 from core.models import CustomUser, ModeloBase
@@ -8,10 +9,21 @@ from django.db import models
 
 
 class Formulario(ModeloBase):
+    ALMACENAMIENTO_EAV = 'eav'
+    ALMACENAMIENTO_DOCUMENTO = 'documento'
+    ALMACENAMIENTO_CHOICES = (
+        (ALMACENAMIENTO_EAV, 'Clave-valor (una fila por campo)'),
+        (ALMACENAMIENTO_DOCUMENTO, 'Documento JSON'),
+    )
+
     nombre = models.CharField(max_length=1024)
     json = models.JSONField()
     fecha = models.DateTimeField(auto_now_add=True)
     version = models.PositiveIntegerField(default=1)
+    almacenamiento = models.CharField(max_length=20, choices=ALMACENAMIENTO_CHOICES, default=ALMACENAMIENTO_EAV)
+    eliminacion_pendiente = models.BooleanField(default=False, db_index=True)  # Se purga en segundo plano
+    # No guarda las respuestas de campos ocultos por su `conditional` (salvo validate_when_hidden)
+    limpiar_ocultos = models.BooleanField(default=False)
 
     def __str__(self):
         return self.nombre
@@ -116,6 +128,7 @@ class CampoDefinido(ModeloBase):
     validate_when_hidden = models.BooleanField(default=False)
     default_value = models.CharField(null=True, blank=True, max_length=1024)
     table_view = models.BooleanField(default=False)
+    indexado = models.BooleanField(default=False)  # Se proyecta a CampoRespuesta en almacenamiento 'documento'
     visible_para = models.ManyToManyField(Group, blank=True)
     activo = models.BooleanField(default=True)
 
@@ -132,6 +145,11 @@ class Encuesta(ModeloBase):
     fecha_fin = models.DateField(null=True, blank=True)
     creada_por = models.ForeignKey(CustomUser, null=True, on_delete=models.SET_NULL)
     creada_en = models.DateTimeField(auto_now_add=True)
+    eliminacion_pendiente = models.BooleanField(default=False, db_index=True)  # Se purga en segundo plano
+    # Contadores cacheados: se actualizan al responder y se recalculan con `recalcular_contadores`
+    total_respuestas = models.PositiveIntegerField(default=0)
+    ultima_respuesta = models.DateTimeField(null=True, blank=True)
+    estadisticas_aproximadas = models.BooleanField(default=False)  # Mantiene SketchCampo en cada envío
 
     def __str__(self):
         return self.nombre
@@ -142,6 +160,14 @@ class RespuestaEncuesta(ModeloBase):
     usuario = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True)
     version = models.PositiveIntegerField()
     enviado = models.DateTimeField(auto_now_add=True)
+    datos = models.JSONField(null=True, blank=True)  # Envío completo en almacenamiento 'documento'
+    # Claves generadas por el cliente para descartar reenvíos (idempotencia)
+    clave_envio = models.CharField(max_length=64, null=True, blank=True, unique=True)
+    ultima_clave_edicion = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        # Orden de la tabla de resultados y de la navegación anterior/siguiente
+        indexes = [models.Index(fields=['encuesta', '-enviado', '-id'])]
 
     def __str__(self):
         return f"Respuesta de {self.usuario}"
@@ -151,8 +177,12 @@ class CampoRespuesta(ModeloBase):
     respuesta = models.ForeignKey(RespuestaEncuesta, on_delete=models.CASCADE, related_name='campos')
     campo_definido = models.ForeignKey(CampoDefinido, on_delete=models.CASCADE)
 
-    clave = models.CharField(max_length=100)
-    etiqueta = models.CharField(max_length=1024, blank=True)
+    # La clave y la etiqueta no se copian en cada fila: se resuelven desde campo_definido
+    # y desde el schema de la versión respondida (ver las propiedades `clave` y `etiqueta`).
+    # Columnas antiguas, ya sin uso: se mantienen (nulables, con '' para las filas nuevas) hasta
+    # ejecutar `compactar_campos_respuesta` y se eliminarán en la versión siguiente.
+    clave_legado = models.CharField(max_length=100, null=True, blank=True, default='', db_column='clave', editable=False)
+    etiqueta_legado = models.CharField(max_length=1024, null=True, blank=True, default='', db_column='etiqueta', editable=False)
     valor = models.TextField() # Valor original como texto/JSON
     
     valor_numerico = models.FloatField(null=True, blank=True)
@@ -162,5 +192,172 @@ class CampoRespuesta(ModeloBase):
     valor_booleano = models.BooleanField(null=True, blank=True)
     valor_lista = models.JSONField(null=True, blank=True)  # Para select múltiple
 
+    # Respuestas de select/radio/selectboxes codificadas con el diccionario OpcionCampo del campo.
+    # Cuando hay código, `valor` y `valor_lista` se guardan vacíos y se reconstruyen al leer la fila.
+    valor_codigo = models.PositiveSmallIntegerField(null=True, blank=True, db_index=True)
+    valor_codigos = models.JSONField(null=True, blank=True)  # [códigos] o {código: marcado}
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instancia = super().from_db(db, field_names, values)
+        datos = instancia.__dict__
+        if datos.get('valor') == '' and (datos.get('valor_codigo') is not None or datos.get('valor_codigos') is not None):
+            from .utils import decodificar_opciones
+            instancia.valor, instancia.valor_lista = decodificar_opciones(
+                instancia.campo_definido_id, datos.get('valor_codigo'), datos.get('valor_codigos')
+            )
+        return instancia
+
+    @property
+    def clave(self):
+        if CampoRespuesta.campo_definido.is_cached(self):
+            return self.campo_definido.clave
+        from .utils import clave_campo_definido
+        return clave_campo_definido(self.campo_definido_id)
+
+    @property
+    def etiqueta(self):
+        """
+        Etiqueta del campo tal como estaba en la versión del formulario con la que se respondió.
+        """
+        from .utils import etiqueta_campo_respuesta
+        return etiqueta_campo_respuesta(self)
+
+    def valores_persistidos(self):
+        """
+        Devuelve (valor, valor_lista) tal como se guardan en la base de datos.
+        """
+        if self.valor_codigo is not None or self.valor_codigos is not None:
+            return '', None
+        return self.valor, self.valor_lista
+
+    def save(self, *args, **kwargs):
+        valor, valor_lista = self.valor, self.valor_lista
+        self.valor, self.valor_lista = self.valores_persistidos()
+        try:
+            super().save(*args, **kwargs)
+        finally:
+            self.valor, self.valor_lista = valor, valor_lista
+
+
+class TareaRetipado(ModeloBase):
+    """
+    Re-tipado pendiente de las respuestas de un campo cuyo tipo cambió al sincronizar el schema.
+    Se procesa por lotes con el comando `retipar_respuestas`, que guarda el punto de control en `ultimo_id`.
+    """
+    campo_definido = models.ForeignKey(CampoDefinido, on_delete=models.CASCADE, related_name='tareas_retipado')
+    tipo_anterior = models.CharField(max_length=20)
+    tipo_nuevo = models.CharField(max_length=20)
+    ultimo_id = models.PositiveBigIntegerField(default=0)  # Último CampoRespuesta procesado
+    procesados = models.PositiveIntegerField(default=0)
+    no_convertibles = models.PositiveIntegerField(default=0)
+    errores = models.JSONField(default=list, blank=True)  # Muestra de valores que ya no se pueden convertir
+    completada = models.BooleanField(default=False)
+    creada_en = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.campo_definido}: {self.tipo_anterior} → {self.tipo_nuevo}"
+
+
+class ResumenEnvios(ModeloBase):
+    """
+    Conteo precalculado de envíos por (encuesta, versión del formulario, hora).
+    Se incrementa al responder una encuesta y se reconstruye con `reconstruir_resumen_envios`.
+    """
+    encuesta = models.ForeignKey(Encuesta, on_delete=models.CASCADE, related_name='resumen_envios')
+    formulario = models.ForeignKey(Formulario, on_delete=models.CASCADE, related_name='resumen_envios')
+    version = models.PositiveIntegerField()
+    intervalo = models.DateTimeField()  # Inicio de la hora (UTC)
+    total = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('encuesta', 'version', 'intervalo')
+        indexes = [models.Index(fields=['formulario', 'intervalo'])]
+
+    def __str__(self):
+        return f"{self.encuesta} v{self.version} {self.intervalo:%Y-%m-%d %H:00}: {self.total}"
+
+
+class SketchCampo(ModeloBase):
+    """
+    Resúmenes aproximados (ver custom_forms.sketches) de las respuestas de un campo en una encuesta:
+    valores distintos (HyperLogLog), cuantiles numéricos (KLL) y valores más frecuentes (Space-Saving).
+    """
+    encuesta = models.ForeignKey(Encuesta, on_delete=models.CASCADE, related_name='sketches')
+    campo_definido = models.ForeignKey(CampoDefinido, on_delete=models.CASCADE, related_name='sketches')
+    total = models.PositiveBigIntegerField(default=0)
+    distintos = models.JSONField(null=True, blank=True)
+    cuantiles = models.JSONField(null=True, blank=True)
+    frecuentes = models.JSONField(null=True, blank=True)
+
+    class Meta:
+        unique_together = ('encuesta', 'campo_definido')
+
+    def __str__(self):
+        return f"{self.encuesta} - {self.campo_definido}"
+
+
+class SketchPendiente(ModeloBase):
+    """
+    Valores de un envío aún no agregados a los SketchCampo de su encuesta. Cada envío inserta una
+    fila sin bloquear los resúmenes compartidos; `consolidar_sketches` las agrega por lotes.
+    """
+    encuesta = models.ForeignKey(Encuesta, on_delete=models.CASCADE, related_name='sketches_pendientes')
+    valores = models.JSONField()  # {campo_definido_id: [valor, valor_numerico]}
+
+    def __str__(self):
+        return f"{self.encuesta} #{self.pk}"
+
+
+class OpcionCampo(ModeloBase):
+    """
+    Diccionario de opciones de un campo de selección: cada valor permitido recibe un código entero
+    estable. Se construye desde CampoDefinido.values y solo se extiende (los códigos no se reutilizan).
+    """
+    campo_definido = models.ForeignKey(CampoDefinido, on_delete=models.CASCADE, related_name='opciones')
+    codigo = models.PositiveSmallIntegerField()
+    valor = models.CharField(max_length=1024)
+    etiqueta = models.CharField(max_length=1024, blank=True)
+
+    class Meta:
+        unique_together = (('campo_definido', 'codigo'), ('campo_definido', 'valor'))
+        ordering = ['codigo']
+
+    def __str__(self):
+        return f"{self.codigo}: {self.etiqueta or self.valor}"
+
+
+class EventoSalida(ModeloBase):
+    """
+    Outbox transaccional: evento de envío/edición de una respuesta escrito en la misma transacción
+    que la respuesta y entregado por lotes con el comando `despachar_eventos`.
+    """
+    PENDIENTE = 'pendiente'
+    ENVIADO = 'enviado'
+    FALLIDO = 'fallido'
+    ESTADO_CHOICES = (
+        (PENDIENTE, 'Pendiente'),
+        (ENVIADO, 'Enviado'),
+        (FALLIDO, 'Fallido'),
+    )
+
+    tipo = models.CharField(max_length=50)  # respuesta.creada, respuesta.editada
+    encuesta = models.ForeignKey(Encuesta, on_delete=models.CASCADE, related_name='eventos_salida')
+    respuesta_id = models.PositiveBigIntegerField()
+    payload = models.JSONField()
+    estado = models.CharField(max_length=20, choices=ESTADO_CHOICES, default=PENDIENTE)
+    intentos = models.PositiveIntegerField(default=0)
+    proximo_intento = models.DateTimeField(default=timezone.now)
+    ultimo_error = models.TextField(blank=True)
+    creado_en = models.DateTimeField(auto_now_add=True)
+    enviado_en = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['estado', 'proximo_intento'])]
+
+    def __str__(self):
+        return f"{self.tipo} #{self.respuesta_id} ({self.estado})"
 
+    def a_dict(self):
+        return {'id': self.id, 'tipo': self.tipo, 'creado_en': self.creado_en.isoformat(), 'datos': self.payload}
 
@@ -0,0 +1,179 @@
+"""
+Procesamiento en paralelo de encuestas grandes por rangos de RespuestaEncuesta.id.
+
+Las respuestas se dividen en rangos (desde_id, hasta_id] con un número fijo de respuestas,
+y cada rango se procesa en un proceso de un pool (fork) con su propia conexión a la base
+de datos. Los rangos dependen solo de los datos y no del número de procesos, y los
+resultados se combinan en el orden de los rangos, así que exportaciones y agregados son
+idénticos con 1 o N procesos.
+"""
+import math, multiprocessing, os
+from collections import Counter
+
+from django.db import connections
+from django.db.models import Max
+
+from .models import RespuestaEncuesta, CampoDefinido
+from .utils import iterar_filas_tipadas, valor_desde_texto, es_valor_vacio, TIPOS_OPCIONES
+
+
+def rangos_respuestas(encuesta, respuestas_por_rango, desde_id=0, hasta_id=None):
+    """
+    Devuelve [(desde_id, hasta_id), ...] cubriendo las respuestas de la encuesta con id > desde_id
+    (y <= hasta_id si se indica), con a lo sumo `respuestas_por_rango` respuestas en cada rango.
+    """
+    ids = RespuestaEncuesta.objects.filter(encuesta=encuesta).order_by('id').values_list('id', flat=True)
+    if hasta_id is not None:
+        ids = ids.filter(id__lte=hasta_id)
+    rangos = []
+    inicio = desde_id
+    while True:
+        corte = list(ids.filter(id__gt=inicio)[respuestas_por_rango - 1:respuestas_por_rango])
+        if not corte:
+            ultimo = ids.filter(id__gt=inicio).aggregate(maximo=Max('id'))['maximo']
+            if ultimo is not None:
+                rangos.append((inicio, ultimo))
+            return rangos
+        rangos.append((inicio, corte[0]))
+        inicio = corte[0]
+
+
+def _aplicar(tarea):
+    funcion, argumentos = tarea
+    return funcion(*argumentos)
+
+
+def ejecutar_en_paralelo(funcion, tareas, procesos=None):
+    """
+    Ejecuta funcion(*tarea) para cada tarea en un pool de procesos y devuelve (generador)
+    los resultados en el orden de `tareas`. `funcion` debe ser una función de módulo.
+    Con un solo proceso se ejecuta en el proceso actual, sin pool.
+    """
+    tareas = list(tareas)
+    procesos = min(procesos or os.cpu_count() or 1, len(tareas))
+    if procesos <= 1:
+        for tarea in tareas:
+            yield funcion(*tarea)
+        return
+
+    # Los hijos no deben heredar sockets abiertos: cada proceso abre su propia conexión
+    connections.close_all()
+    with multiprocessing.get_context('fork').Pool(procesos) as pool:
+        yield from pool.imap(_aplicar, [(funcion, tarea) for tarea in tareas])
+
+
+def _agregado_vacio():
+    return {
+        'conteo': 0, 'media': 0.0, 'm2': 0.0,
+        'minimo': None, 'maximo': None, 'frecuencias': Counter(),
+    }
+
+
+def _actualizar_extremos(agregado, minimo, maximo):
+    if minimo is not None and (agregado['minimo'] is None or minimo < agregado['minimo']):
+        agregado['minimo'] = minimo
+    if maximo is not None and (agregado['maximo'] is None or maximo > agregado['maximo']):
+        agregado['maximo'] = maximo
+
+
+def agregar_rango(encuesta, campos_definidos, desde_id, hasta_id, tamano_lote=1000):
+    """
+    Agregados parciales de las respuestas con id en (desde_id, hasta_id]:
+    {'respuestas': n, 'campos': {clave: {conteo, media, m2, minimo, maximo, frecuencias}}}.
+    Media y m2 (suma de cuadrados de las desviaciones a la media, algoritmo de Welford) solo para
+    campos numéricos (y horas, en segundos): a diferencia de suma_cuadrados/n - media², no pierden
+    precisión con valores grandes y varianza pequeña. Frecuencias para opciones y booleanos; mínimo
+    y máximo para números, fechas y horas.
+    """
+    tipos = {campo.clave: campo.tipo for campo in campos_definidos}
+    campos = {}
+    respuestas = 0
+
+    for _, valores in iterar_filas_tipadas(encuesta, campos_definidos, desde_id, hasta_id, tamano_lote):
+        respuestas += 1
+        for clave, valor in valores.items():
+            if es_valor_vacio(valor):
+                continue
+            tipo = tipos[clave]
+            agregado = campos.setdefault(clave, _agregado_vacio())
+            agregado['conteo'] += 1
+
+            if tipo in ('number', 'time'):
+                delta = valor - agregado['media']
+                agregado['media'] += delta / agregado['conteo']
+                agregado['m2'] += delta * (valor - agregado['media'])
+                _actualizar_extremos(agregado, valor, valor)
+            elif tipo in ('date', 'datetime'):
+                _actualizar_extremos(agregado, valor, valor)
+            elif tipo == 'boolean':
+                agregado['frecuencias'][str(valor).lower()] += 1
+            elif tipo == 'multi_select':
+                seleccion = valor_desde_texto(valor)
+                if isinstance(seleccion, dict):
+                    seleccion = [opcion for opcion, marcada in seleccion.items() if marcada]
+                elif not isinstance(seleccion, list):
+                    seleccion = [seleccion]
+                agregado['frecuencias'].update(str(opcion) for opcion in seleccion)
+            elif tipo in TIPOS_OPCIONES:
+                agregado['frecuencias'][valor] += 1
+
+    return {'respuestas': respuestas, 'campos': campos}
+
+
+def _combinar_momentos(acumulado, agregado):
+    conteo_a, conteo_b = acumulado['conteo'], agregado['conteo']
+    conteo = conteo_a + conteo_b
+    if conteo_b:
+        delta = agregado['media'] - acumulado['media']
+        acumulado['media'] += delta * conteo_b / conteo
+        acumulado['m2'] += agregado['m2'] + delta * delta * conteo_a * conteo_b / conteo
+    acumulado['conteo'] = conteo
+
+
+def combinar_agregados(parciales):
+    """
+    Combina los agregados parciales de agregar_rango en el orden recibido. Media y m2 se combinan con
+    la fórmula de Chan et al.; como el orden de los rangos no depende del número de procesos, el
+    resultado es el mismo con 1 o N procesos.
+    """
+    total = {'respuestas': 0, 'campos': {}}
+    for parcial in parciales:
+        total['respuestas'] += parcial['respuestas']
+        for clave, agregado in parcial['campos'].items():
+            acumulado = total['campos'].setdefault(clave, _agregado_vacio())
+            _combinar_momentos(acumulado, agregado)
+            acumulado['frecuencias'].update(agregado['frecuencias'])
+            _actualizar_extremos(acumulado, agregado['minimo'], agregado['maximo'])
+    return total
+
+
+def estadisticas_encuesta(encuesta, procesos=None, respuestas_por_rango=50000, tamano_lote=1000, frecuentes=10):
+    """
+    Estadísticas exactas por campo activo de una encuesta, calculadas en paralelo por rangos de id:
+    {'respuestas': n, 'campos': {clave: {tipo, etiqueta, conteo, media, desviacion, minimo, maximo, frecuentes}}}.
+    """
+    campos_definidos = list(CampoDefinido.objects.filter(formulario_id=encuesta.formulario_id, activo=True).order_by('id'))
+    rangos = rangos_respuestas(encuesta, respuestas_por_rango)
+    total = combinar_agregados(ejecutar_en_paralelo(
+        agregar_rango, [(encuesta, campos_definidos, desde, hasta, tamano_lote) for desde, hasta in rangos], procesos
+    ))
+
+    campos = {}
+    for campo in campos_definidos:
+        agregado = total['campos'].get(campo.clave, _agregado_vacio())
+        resumen = {
+            'tipo': campo.tipo,
+            'etiqueta': campo.etiqueta,
+            'conteo': agregado['conteo'],
+            'minimo': agregado['minimo'],
+            'maximo': agregado['maximo'],
+        }
+        if campo.tipo in ('number', 'time') and agregado['conteo']:
+            resumen['media'] = agregado['media']
+            resumen['desviacion'] = math.sqrt(agregado['m2'] / agregado['conteo'])
+        if agregado['frecuencias']:
+            # Orden estable ante empates para que la salida no dependa del reparto entre procesos
+            resumen['frecuentes'] = sorted(agregado['frecuencias'].items(), key=lambda item: (-item[1], item[0]))[:frecuentes]
+        campos[campo.clave] = resumen
+
+    return {'respuestas': total['respuestas'], 'campos': campos}
@@ -0,0 +1,129 @@
+"""
+Enrutamiento de las lecturas de reportes (resultados, versiones, exportaciones y
+listados del admin) a una base de datos réplica.
+
+Configuración en settings:
+
+    DATABASE_ROUTERS = ['custom_forms.routers.ReplicaLecturaRouter']
+    CUSTOM_FORMS_REPLICA_DB = 'replica'              # alias en DATABASES
+    CUSTOM_FORMS_FIJAR_PRIMARIA_SEGUNDOS = 5         # read-after-write tras un POST
+
+Solo las vistas marcadas con `lectura_en_replica` leen de la réplica; el resto de
+lecturas y todas las escrituras van a la base de datos primaria.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+_alias_lectura = ContextVar('custom_forms_alias_lectura', default=None)
+
+SESION_PRIMARIA_HASTA = 'custom_forms_primaria_hasta'
+
+
+def alias_replica():
+    return getattr(settings, 'CUSTOM_FORMS_REPLICA_DB', None)
+
+
+@contextmanager
+def leer_de_replica(alias=None):
+    """
+    Envía a la réplica las lecturas ejecutadas dentro del bloque.
+    """
+    token = _alias_lectura.set(alias or alias_replica())
+    try:
+        yield
+    finally:
+        _alias_lectura.reset(token)
+
+
+def fijar_primaria(request):
+    """
+    Tras una escritura, fija las lecturas de la sesión a la primaria durante unos segundos,
+    para que la redirección posterior no lea datos desactualizados de la réplica.
+    """
+    session = getattr(request, 'session', None)
+    if session is not None and alias_replica():
+        session[SESION_PRIMARIA_HASTA] = time.time() + getattr(settings, 'CUSTOM_FORMS_FIJAR_PRIMARIA_SEGUNDOS', 5)
+
+
+def fijada_a_primaria(request):
+    session = getattr(request, 'session', None)
+    hasta = session.get(SESION_PRIMARIA_HASTA) if session is not None else None
+    return hasta is not None and hasta > time.time()
+
+
+def alias_lectura(request):
+    """
+    Alias de base de datos para las lecturas de reportes de esta petición.
+    Útil para querysets que se evalúan fuera de la vista (p. ej. respuestas en streaming).
+    """
+    if alias_replica() and not fijada_a_primaria(request):
+        return alias_replica()
+    return DEFAULT_DB_ALIAS
+
+
+def lectura_en_replica(accion):
+    """
+    Decorador para acciones de solo lectura de las vistas de administración
+    (métodos con firma `(self, request, context, ...)`).
+    """
+    @wraps(accion)
+    def envoltura(self, request, *args, **kwargs):
+        if alias_lectura(request) == DEFAULT_DB_ALIAS:
+            return accion(self, request, *args, **kwargs)
+        with leer_de_replica():
+            return accion(self, request, *args, **kwargs)
+    return envoltura
+
+
+class LecturaReplicaAdminMixin:
+    """
+    Mixin para ModelAdmin: el listado (changelist) lee de la réplica y las escrituras
+    fijan la sesión a la primaria.
+    """
+    def changelist_view(self, request, extra_context=None):
+        if request.method != 'GET' or alias_lectura(request) == DEFAULT_DB_ALIAS:
+            return super().changelist_view(request, extra_context)
+        with leer_de_replica():
+            response = super().changelist_view(request, extra_context)
+            # TemplateResponse se renderiza de forma diferida: forzarlo dentro del bloque
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        fijar_primaria(request)
+
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        fijar_primaria(request)
+
+    def delete_queryset(self, request, queryset):
+        super().delete_queryset(request, queryset)
+        fijar_primaria(request)
+
+
+class ReplicaLecturaRouter:
+    """
+    Router de base de datos: usa la réplica solo para las lecturas hechas dentro de
+    `leer_de_replica`. Las escrituras siempre quedan en la primaria.
+    """
+    def db_for_read(self, model, **hints):
+        return _alias_lectura.get()
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        bases = {DEFAULT_DB_ALIAS, alias_replica()}
+        if obj1._state.db in bases and obj2._state.db in bases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
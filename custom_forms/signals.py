@@ -0,0 +1,40 @@
+from django.db.models.signals import m2m_changed, post_save, post_delete
+from django.dispatch import receiver
+
+from .models import CampoDefinido, RespuestaEncuesta, CampoRespuesta
+from .utils import invalidar_visibilidad, invalidar_snapshot
+
+
+@receiver(m2m_changed, sender=CampoDefinido.visible_para.through)
+def visibilidad_cambiada(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        invalidar_visibilidad(instance.formulario_id)
+    elif pk_set:
+        # Cambio desde el lado del grupo: invalidar los formularios de los campos afectados
+        formularios = CampoDefinido.objects.filter(pk__in=pk_set).values_list('formulario_id', flat=True).distinct()
+        for formulario_id in formularios:
+            invalidar_visibilidad(formulario_id)
+    else:
+        invalidar_visibilidad()
+
+
+@receiver(post_save, sender=CampoDefinido)
+@receiver(post_delete, sender=CampoDefinido)
+def campo_definido_cambiado(sender, instance, **kwargs):
+    invalidar_visibilidad(instance.formulario_id)
+
+
+@receiver(post_save, sender=CampoRespuesta)
+@receiver(post_delete, sender=CampoRespuesta)
+def campo_respuesta_cambiado(sender, instance, **kwargs):
+    # Cambios fuera de guardar_o_actualizar_campos_respuesta (admin, scripts): el snapshot ya no vale
+    invalidar_snapshot(instance.respuesta_id)
+
+
+@receiver(post_save, sender=RespuestaEncuesta)
+@receiver(post_delete, sender=RespuestaEncuesta)
+def respuesta_cambiada(sender, instance, **kwargs):
+    invalidar_snapshot(instance.pk)
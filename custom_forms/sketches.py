@@ -0,0 +1,161 @@
+"""
+Estructuras de resumen aproximado (sketches) para estadísticas de encuestas muy grandes.
+
+Todas se serializan a JSON (`a_dict` / `desde_dict`) para guardarse en SketchCampo y
+son combinables (`combinar`), de modo que los resúmenes de varias encuestas que
+comparten un Formulario se pueden unir sin volver a leer las respuestas.
+"""
+import base64, hashlib, math, random
+
+
+def _hash64(valor):
+    return int.from_bytes(hashlib.blake2b(str(valor).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HyperLogLog:
+    """
+    Conteo aproximado de valores distintos (error típico ~1.04/sqrt(2^p), 1.6% con p=12).
+    """
+    def __init__(self, p=12, registros=None):
+        self.p = p
+        self.m = 1 << p
+        self.registros = bytearray(registros) if registros is not None else bytearray(self.m)
+
+    def agregar(self, valor):
+        h = _hash64(valor)
+        indice = h >> (64 - self.p)
+        resto = h & ((1 << (64 - self.p)) - 1)
+        rango = (64 - self.p) - resto.bit_length() + 1
+        if rango > self.registros[indice]:
+            self.registros[indice] = rango
+
+    def combinar(self, otro):
+        if otro.p != self.p:
+            raise ValueError("No se pueden combinar HyperLogLog con distinta precisión")
+        self.registros = bytearray(max(a, b) for a, b in zip(self.registros, otro.registros))
+        return self
+
+    def estimar(self):
+        alfa = 0.7213 / (1 + 1.079 / self.m)
+        estimado = alfa * self.m * self.m / sum(2.0 ** -r for r in self.registros)
+        vacios = self.registros.count(0)
+        if estimado <= 2.5 * self.m and vacios:
+            # Corrección para rangos pequeños (linear counting)
+            estimado = self.m * math.log(self.m / vacios)
+        return int(round(estimado))
+
+    def a_dict(self):
+        return {'p': self.p, 'registros': base64.b64encode(bytes(self.registros)).decode('ascii')}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        if not datos:
+            return cls()
+        return cls(datos['p'], base64.b64decode(datos['registros']))
+
+
+class KLL:
+    """
+    Sketch de cuantiles tipo KLL: niveles de compactadores de capacidad k donde cada
+    elemento del nivel h pesa 2^h. Error de rango aproximado O(1/k).
+    """
+    def __init__(self, k=200, niveles=None, n=0):
+        self.k = k
+        self.niveles = niveles if niveles is not None else [[]]
+        self.n = n
+
+    def agregar(self, valor):
+        self.niveles[0].append(float(valor))
+        self.n += 1
+        self._compactar()
+
+    def _compactar(self):
+        h = 0
+        while h < len(self.niveles):
+            if len(self.niveles[h]) > self.k:
+                if h + 1 == len(self.niveles):
+                    self.niveles.append([])
+                nivel = sorted(self.niveles[h])
+                # Si es impar, el último elemento se queda en el nivel actual
+                sobrante = [nivel.pop()] if len(nivel) % 2 else []
+                desplazamiento = random.randint(0, 1)
+                self.niveles[h + 1].extend(nivel[desplazamiento::2])
+                self.niveles[h] = sobrante
+            h += 1
+
+    def combinar(self, otro):
+        while len(self.niveles) < len(otro.niveles):
+            self.niveles.append([])
+        for h, nivel in enumerate(otro.niveles):
+            self.niveles[h].extend(nivel)
+        self.n += otro.n
+        self._compactar()
+        return self
+
+    def cuantil(self, q):
+        ponderados = sorted(
+            (valor, 1 << h) for h, nivel in enumerate(self.niveles) for valor in nivel
+        )
+        if not ponderados:
+            return None
+        total = sum(peso for _, peso in ponderados)
+        objetivo = q * total
+        acumulado = 0
+        for valor, peso in ponderados:
+            acumulado += peso
+            if acumulado >= objetivo:
+                return valor
+        return ponderados[-1][0]
+
+    def a_dict(self):
+        return {'k': self.k, 'n': self.n, 'niveles': self.niveles}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        if not datos:
+            return cls()
+        return cls(datos['k'], [list(nivel) for nivel in datos['niveles']], datos['n'])
+
+
+class EspacioAhorro:
+    """
+    Valores más frecuentes (heavy hitters) con el algoritmo Space-Saving:
+    mantiene a lo sumo `capacidad` contadores; el conteo sobreestima como máximo en `error`.
+    """
+    def __init__(self, capacidad=100, contadores=None):
+        self.capacidad = capacidad
+        self.contadores = contadores if contadores is not None else {}  # valor -> [conteo, error]
+
+    def agregar(self, valor, veces=1):
+        valor = str(valor)
+        if valor in self.contadores:
+            self.contadores[valor][0] += veces
+        elif len(self.contadores) < self.capacidad:
+            self.contadores[valor] = [veces, 0]
+        else:
+            minimo = min(self.contadores, key=lambda v: self.contadores[v][0])
+            conteo_minimo = self.contadores.pop(minimo)[0]
+            self.contadores[valor] = [conteo_minimo + veces, conteo_minimo]
+
+    def combinar(self, otro):
+        for valor, (conteo, error) in otro.contadores.items():
+            actual = self.contadores.setdefault(valor, [0, 0])
+            actual[0] += conteo
+            actual[1] += error
+        if len(self.contadores) > self.capacidad:
+            mayores = sorted(self.contadores.items(), key=lambda item: item[1][0], reverse=True)
+            self.contadores = dict(mayores[:self.capacidad])
+        return self
+
+    def frecuentes(self, n=10):
+        mayores = sorted(self.contadores.items(), key=lambda item: item[1][0], reverse=True)
+        return [(valor, conteo) for valor, (conteo, _) in mayores[:n]]
+
+    def a_dict(self):
+        return {'capacidad': self.capacidad, 'contadores': self.contadores}
+
+    @classmethod
+    def desde_dict(cls, datos):
+        if not datos:
+            return cls()
+        return cls(datos['capacidad'], {v: list(c) for v, c in datos['contadores'].items()})
@@ -1,3 +1,306 @@
-from django.test import TestCase
+import io, json, threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, connection, connections, router, transaction
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+
+from .envios import LectorObjetoJSON, LimiteEnvioExcedido, archivar_grandes, resolver_archivados
+from .eventos import WebhookDestino, despachar_lote
+from .models import Formulario, FormularioVersion, Encuesta, RespuestaEncuesta, EventoSalida
+from .routers import fijar_primaria, lectura_en_replica, leer_de_replica
+from .utils import (
+    actualizar_formulario_y_guardar_version, guardar_o_actualizar_campos_respuesta, normalizar_json, obtener_schema_version
+)
+
+
+def _schema(n):
+    return {'components': [
+        {'type': 'textfield', 'key': 'nombre', 'label': 'Nombre', 'input': True},
+        {'type': 'textfield', 'key': f'campo_{n}', 'label': f'Campo {n}', 'input': True},
+    ]}
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class VersionadoConcurrenteTests(TransactionTestCase):
+    """
+    Ediciones del formulario y envíos simultáneos desde varios hilos: ningún envío debe quedar
+    con una versión sin FormularioVersion, ni fallar por versiones duplicadas.
+    Requiere una base con bloqueo de filas (PostgreSQL, MySQL, Oracle): en SQLite se omite.
+    """
+    editores = 3
+    remitentes = 4
+    iteraciones = 10
+
+    def setUp(self):
+        self.formulario = Formulario.objects.create(nombre='Concurrente', json=_schema(0))
+        self.encuesta = Encuesta.objects.create(formulario=self.formulario, nombre='Concurrente')
+
+    def _hilo(self, barrera, errores, funcion):
+        try:
+            barrera.wait()
+            for i in range(self.iteraciones):
+                funcion(i)
+        except Exception as e:
+            errores.append(e)
+        finally:
+            connection.close()
+
+    def _editar(self, indice):
+        def editar(i):
+            formulario = Formulario.objects.get(pk=self.formulario.pk)
+            actualizar_formulario_y_guardar_version(formulario, _schema(indice * 1000 + i + 1))
+        return editar
+
+    def _responder(self, i):
+        encuesta = Encuesta.objects.select_related('formulario').get(pk=self.encuesta.pk)
+        with transaction.atomic():
+            respuesta = RespuestaEncuesta.objects.create(encuesta=encuesta, version=encuesta.formulario.version)
+            guardar_o_actualizar_campos_respuesta(respuesta, {'nombre': f'respuesta {i}'})
+
+    def test_envio_confirmado_despues_de_una_edicion_conserva_su_schema(self):
+        # Orden forzado: el envío lee la versión N, la edición crea N + 1 y confirma, y recién
+        # entonces el envío guarda su respuesta con N en la misma transacción en que la leyó
+        leida, editada = threading.Event(), threading.Event()
+        errores = []
+
+        def responder():
+            try:
+                with transaction.atomic():
+                    encuesta = Encuesta.objects.select_related('formulario').get(pk=self.encuesta.pk)
+                    version = encuesta.formulario.version
+                    leida.set()
+                    if not editada.wait(10):
+                        raise AssertionError("La edición no terminó")
+                    respuesta = RespuestaEncuesta.objects.create(encuesta=encuesta, version=version)
+                    guardar_o_actualizar_campos_respuesta(respuesta, {'nombre': 'antes de la edición'})
+            except Exception as e:
+                errores.append(e)
+            finally:
+                connection.close()
+
+        hilo = threading.Thread(target=responder)
+        hilo.start()
+        self.assertTrue(leida.wait(10))
+        formulario = Formulario.objects.get(pk=self.formulario.pk)
+        version = formulario.version
+        try:
+            self.assertTrue(actualizar_formulario_y_guardar_version(formulario, _schema(1)))
+        finally:
+            editada.set()
+            hilo.join()
+
+        self.assertEqual(errores, [])
+        respuesta = RespuestaEncuesta.objects.get(encuesta=self.encuesta)
+        self.assertEqual(respuesta.version, version)
+        versiones = dict(FormularioVersion.objects.filter(formulario=self.formulario).values_list('numero', 'json'))
+        self.assertEqual(normalizar_json(versiones[version]), normalizar_json(_schema(0)))
+        self.assertEqual(normalizar_json(versiones[version + 1]), normalizar_json(_schema(1)))
+        self.assertEqual(normalizar_json(obtener_schema_version(self.formulario.pk, version)), normalizar_json(_schema(0)))
+
+    def test_ediciones_y_envios_concurrentes(self):
+        hilos = self.editores + self.remitentes
+        barrera = threading.Barrier(hilos)
+        errores = []
+        funciones = [self._editar(i) for i in range(self.editores)] + [self._responder] * self.remitentes
+        threads = [threading.Thread(target=self._hilo, args=(barrera, errores, f)) for f in funciones]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertFalse([e for e in errores if isinstance(e, IntegrityError)])
+        self.assertEqual(errores, [])
+        self.assertEqual(RespuestaEncuesta.objects.count(), self.remitentes * self.iteraciones)
+
+        versiones = set(FormularioVersion.objects.filter(formulario=self.formulario).values_list('numero', flat=True))
+        usadas = set(RespuestaEncuesta.objects.values_list('version', flat=True))
+        self.assertLessEqual(usadas, versiones)
+        self.assertEqual(Formulario.objects.get(pk=self.formulario.pk).version, max(versiones))
+
+
+class _VistaReportes:
+    @lectura_en_replica
+    def get_resultados(self, request, context):
+        return Formulario.objects.all().db, list(Formulario.objects.all())
+
+
+@override_settings(DATABASE_ROUTERS=['custom_forms.routers.ReplicaLecturaRouter'], CUSTOM_FORMS_REPLICA_DB='replica')
+class ReplicaLecturaRouterTests(TestCase):
+    """
+    Requiere un alias 'replica' en DATABASES (p. ej. con 'TEST': {'MIRROR': 'default'}, ver README).
+    Se comprueba en qué conexión se ejecuta cada consulta, no los datos: con MIRROR ambas leen la misma base.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        self.request = RequestFactory().get('/')
+        self.request.session = {}
+
+    def _consultas(self, funcion):
+        with CaptureQueriesContext(connections['default']) as primaria, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            resultado = funcion()
+        return resultado, len(primaria), len(replica)
+
+    def test_lectura_decorada_va_a_la_replica(self):
+        (alias, _), en_primaria, en_replica = self._consultas(lambda: _VistaReportes().get_resultados(self.request, {}))
+        self.assertEqual(alias, 'replica')
+        self.assertEqual((en_primaria, en_replica), (0, 1))
+
+    def test_lectura_sin_decorar_va_a_la_primaria(self):
+        _, en_primaria, en_replica = self._consultas(lambda: list(Formulario.objects.all()))
+        self.assertEqual((en_primaria, en_replica), (1, 0))
+
+    def test_sesion_fijada_lee_de_la_primaria(self):
+        fijar_primaria(self.request)
+        (alias, _), en_primaria, en_replica = self._consultas(lambda: _VistaReportes().get_resultados(self.request, {}))
+        self.assertEqual(alias, 'default')
+        self.assertEqual((en_primaria, en_replica), (1, 0))
+
+    def test_escrituras_van_a_la_primaria(self):
+        escrituras = ('INSERT', 'UPDATE', 'DELETE')
+        with leer_de_replica(), CaptureQueriesContext(connections['default']) as primaria, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            self.assertEqual(router.db_for_write(Formulario), 'default')
+            formulario = Formulario.objects.create(nombre='Replica', json=_schema(0))
+        self.assertEqual(formulario._state.db, 'default')
+        self.assertTrue(any(q['sql'].lstrip().upper().startswith(escrituras) for q in primaria.captured_queries))
+        self.assertFalse(any(q['sql'].lstrip().upper().startswith(escrituras) for q in replica.captured_queries))
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        cuerpo = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.recibidos.append(json.loads(cuerpo))
+        self.send_response(self.server.estado)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class WebhookDestinoTests(TestCase):
+    """
+    despachar_lote contra un servidor HTTP local que acepta POST.
+    """
+    def setUp(self):
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), _WebhookHandler)
+        self.servidor.recibidos = []
+        self.servidor.estado = 200
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        self.addCleanup(self.servidor.server_close)
+        self.addCleanup(self.servidor.shutdown)
+        self.destino = WebhookDestino(f'http://127.0.0.1:{self.servidor.server_address[1]}/eventos')
+
+        formulario = Formulario.objects.create(nombre='Webhook', json=_schema(0))
+        encuesta = Encuesta.objects.create(formulario=formulario, nombre='Webhook')
+        self.eventos = [
+            EventoSalida.objects.create(tipo='respuesta.creada', encuesta=encuesta, respuesta_id=i, payload={'respuesta_id': i})
+            for i in range(1, 4)
+        ]
+
+    def test_entrega_el_lote(self):
+        self.assertEqual(despachar_lote(self.destino, tamano_lote=10), (3, 0))
+
+        self.assertEqual(len(self.servidor.recibidos), 1)
+        entregados = self.servidor.recibidos[0]['eventos']
+        self.assertEqual([evento['id'] for evento in entregados], [evento.pk for evento in self.eventos])
+        self.assertEqual(entregados[0]['datos'], {'respuesta_id': 1})
+        self.assertFalse(EventoSalida.objects.exclude(estado=EventoSalida.ENVIADO).exists())
+        self.assertEqual(despachar_lote(self.destino), (0, 0))
+
+    def test_error_http_reprograma(self):
+        self.servidor.estado = 500
+        self.assertEqual(despachar_lote(self.destino, max_intentos=2), (0, 3))
+
+        for evento in EventoSalida.objects.all():
+            self.assertEqual(evento.estado, EventoSalida.PENDIENTE)
+            self.assertEqual(evento.intentos, 1)
+            self.assertIn('500', evento.ultimo_error)
+        # Reprogramados con backoff: no vuelven a tomarse de inmediato
+        self.assertEqual(despachar_lote(self.destino), (0, 0))
+
+
+class ArchivadosTests(TestCase):
+    def test_descartar_un_envio_no_afecta_a_otro_igual(self):
+        texto = 'x' * 100
+        creados_a, creados_b = [], []
+        referencia_a = archivar_grandes(texto, 10, creados_a)
+        referencia_b = archivar_grandes(texto, 10, creados_b)
+        self.addCleanup(lambda: [default_storage.delete(nombre) for nombre in creados_b])
+
+        self.assertNotEqual(referencia_a, referencia_b)
+        for nombre in creados_a:
+            default_storage.delete(nombre)  # Envío A falló
+        self.assertEqual(resolver_archivados(referencia_b), texto)
+
+
+class LectorObjetoJSONTests(SimpleTestCase):
+    """
+    Lectura por bloques pequeños: los valores quedan partidos entre bloques.
+    """
+    def _pares(self, texto, **kwargs):
+        kwargs.setdefault('tamano_bloque', 3)
+        return list(LectorObjetoJSON(io.BytesIO(texto.encode('utf-8')), **kwargs).pares())
+
+    def test_valores_partidos_entre_bloques(self):
+        datos = {
+            'nombre': 'José Pérez', 'edad': -125.5e1, 'activo': True, 'nulo': None,
+            'opciones': ['a', 'b', {'c': [1, 2]}], 'firma': 'ñ' * 50,
+        }
+        for tamano_bloque in (1, 2, 3, 7):
+            with self.subTest(tamano_bloque=tamano_bloque):
+                pares = self._pares(json.dumps(datos, ensure_ascii=False), tamano_bloque=tamano_bloque)
+                self.assertEqual(dict(pares), datos)
+                self.assertEqual([clave for clave, _ in pares], list(datos))
+
+    def test_numero_al_final_de_un_bloque(self):
+        # "12" llega en un bloque y "34" en el siguiente: no debe leerse 12
+        self.assertEqual(self._pares('{"a":1234}', tamano_bloque=6), [('a', 1234)])
+        self.assertEqual(self._pares('{"a": 1234 }', tamano_bloque=7), [('a', 1234)])
+
+    def test_objeto_vacio_e_incompleto(self):
+        self.assertEqual(self._pares(' {} '), [])
+        with self.assertRaises(ValueError):
+            self._pares('{"a": "sin cerrar')
+
+    def test_max_envio(self):
+        texto = json.dumps({'a': 'x' * 20, 'b': 'y' * 20})
+        self.assertEqual(len(self._pares(texto, max_envio=len(texto))), 2)
+        with self.assertRaises(LimiteEnvioExcedido):
+            self._pares(texto, max_envio=len(texto) - 1)
+
+    def test_max_envio_en_bytes(self):
+        texto = json.dumps({'a': 'ñ' * 10}, ensure_ascii=False)
+        with self.assertRaises(LimiteEnvioExcedido):
+            self._pares(texto, max_envio=len(texto))
+        self.assertEqual(len(self._pares(texto, max_envio=len(texto.encode('utf-8')))), 1)
+
+    def test_max_campo(self):
+        # El valor incluye sus comillas: '"xxxxxxxxxx"' son 12 bytes
+        self.assertEqual(self._pares('{"a": "xxxxxxxxxx", "b": 1}', max_campo=12), [('a', 'x' * 10), ('b', 1)])
+        with self.assertRaises(LimiteEnvioExcedido):
+            self._pares('{"a": "xxxxxxxxxx", "b": 1}', max_campo=11)
+
+    def test_max_campo_en_bytes(self):
+        # 10 caracteres, 22 bytes en UTF-8 con las comillas
+        texto = json.dumps({'a': 'ñ' * 10}, ensure_ascii=False)
+        with self.assertRaises(LimiteEnvioExcedido):
+            self._pares(texto, max_campo=12)
+        self.assertEqual(self._pares(texto, max_campo=22), [('a', 'ñ' * 10)])
+
+    def test_max_campo_corta_sin_leer_todo(self):
+        leidos = []
+
+        class Flujo(io.BytesIO):
+            def read(self, n=-1):
+                bloque = super().read(n)
+                leidos.append(len(bloque))
+                return bloque
+
+        texto = '{"a": "' + 'x' * 10000 + '"}'
+        with self.assertRaises(LimiteEnvioExcedido):
+            list(LectorObjetoJSON(Flujo(texto.encode('utf-8')), max_campo=100, tamano_bloque=10).pares())
+        self.assertLess(sum(leidos), 1000)
@@ -1,12 +1,23 @@
-import json, re
+import json, re, hashlib
+from collections import Counter
 
+from django.conf import settings
 from django.contrib.auth.models import Group
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F, Q, Sum, Count, Max, OuterRef, Subquery, Prefetch
+from django.db.models.functions import Cast, Coalesce, TruncHour
+from django.core.cache import cache
+from django.core.files.storage import default_storage
 from django.core.exceptions import ValidationError
 
-from datetime import datetime
+from datetime import datetime, timezone
 
-from .models import CampoDefinido, CampoRespuesta, RespuestaEncuesta, FormularioVersion
+from .models import (
+    Formulario, Encuesta, CampoDefinido, CampoRespuesta, RespuestaEncuesta, FormularioVersion, TareaRetipado,
+    ResumenEnvios, SketchCampo, SketchPendiente, OpcionCampo, EventoSalida
+)
+from .sketches import HyperLogLog, KLL, EspacioAhorro
+from .envios import PREFIJO_ARCHIVADO, REFERENCIA_ARCHIVADO, resolver_archivados, directorio_archivados
 
 formio_type_to_logical_type = {
     "textfield": "text",
@@ -160,6 +171,7 @@ def sincronizar_campos_definidos(formulario, schema):
 
         if clave in actuales:
             campo = actuales[clave]
+            tipo_anterior = campo.tipo
             campo.etiqueta              = etiqueta
             campo.tipo                  = tipo_log
             campo.tipo_original         = tipo_orig
@@ -171,6 +183,11 @@ def sincronizar_campos_definidos(formulario, schema):
             campo.table_view           = table_view
             campo.activo                = True
             campo.save()
+
+            diccionario_nuevo = sincronizar_opciones(campo)
+            if tipo_anterior != tipo_log or diccionario_nuevo:
+                # El re-tipado también codifica las respuestas existentes con el diccionario nuevo
+                programar_retipado(campo, tipo_anterior)
         else:
             nuevo = CampoDefinido.objects.create(
                 formulario=formulario,
@@ -188,6 +205,7 @@ def sincronizar_campos_definidos(formulario, schema):
             )
             if admin_group:
                 nuevo.visible_para.add(admin_group)
+            sincronizar_opciones(nuevo)
 
     # Marcar campos eliminados como inactivos
     for clave, campo in actuales.items():
@@ -196,91 +214,626 @@ def sincronizar_campos_definidos(formulario, schema):
             campo.save()
 
 
+CAMPOS_TIPADOS = [
+    'valor_numerico', 'valor_fecha', 'valor_time', 'valor_datetime', 'valor_booleano', 'valor_lista',
+    'valor_codigo', 'valor_codigos',
+]
+
+TIPOS_OPCIONES = ('select', 'radio', 'multi_select')
+
+# Memoria local {campo_definido_id: {'por_codigo': {...}, 'por_valor': {...}}}. Es coherente entre
+# procesos porque el diccionario solo crece: ante un código o valor desconocido se recarga.
+_diccionarios_opciones = {}
+
+
+def diccionario_opciones(campo_definido_id, recargar=False):
+    """
+    Devuelve el diccionario de opciones de un campo: {'por_codigo': {codigo: valor}, 'por_valor': {valor: codigo}}.
+    """
+    if recargar or campo_definido_id not in _diccionarios_opciones:
+        filas = list(OpcionCampo.objects.filter(campo_definido_id=campo_definido_id).values_list('codigo', 'valor'))
+        _diccionarios_opciones[campo_definido_id] = {
+            'por_codigo': dict(filas),
+            'por_valor': {valor: codigo for codigo, valor in filas},
+        }
+    return _diccionarios_opciones[campo_definido_id]
+
+
+def sincronizar_opciones(campo_definido):
+    """
+    Extiende el diccionario OpcionCampo de un campo de selección con los `values` del schema.
+    Las opciones existentes conservan su código (se actualiza la etiqueta); nunca se eliminan.
+    Retorna True si el campo no tenía diccionario y se acaba de crear.
+    """
+    if campo_definido.tipo not in TIPOS_OPCIONES or not isinstance(campo_definido.values, list):
+        return False
+
+    existentes = {opcion.valor: opcion for opcion in OpcionCampo.objects.filter(campo_definido=campo_definido)}
+    siguiente = max((opcion.codigo for opcion in existentes.values()), default=0) + 1
+    nuevas = []
+
+    for item in campo_definido.values:
+        if not isinstance(item, dict) or item.get('value') in (None, ''):
+            continue
+        valor = str(item['value'])
+        etiqueta = str(item.get('label', valor))[:1024]
+        if valor in existentes:
+            opcion = existentes[valor]
+            if opcion.etiqueta != etiqueta:
+                opcion.etiqueta = etiqueta
+                opcion.save(update_fields=['etiqueta'])
+        elif len(valor) <= 1024:
+            nuevas.append(OpcionCampo(campo_definido=campo_definido, codigo=siguiente, valor=valor, etiqueta=etiqueta))
+            existentes[valor] = nuevas[-1]
+            siguiente += 1
+
+    if nuevas:
+        OpcionCampo.objects.bulk_create(nuevas)
+        _diccionarios_opciones.pop(campo_definido.pk, None)
+    return bool(nuevas) and len(nuevas) == len(existentes)
+
+
+def _codigo_opcion(campo_definido_id, valor):
+    diccionario = diccionario_opciones(campo_definido_id)
+    if valor not in diccionario['por_valor']:
+        diccionario = diccionario_opciones(campo_definido_id, recargar=True)
+    return diccionario['por_valor'].get(valor)
+
+
+def codificar_opciones(campo, campo_definido, valor):
+    """
+    Asigna valor_codigo / valor_codigos si todas las opciones respondidas están en el diccionario del campo:
+    - select/radio con un valor: valor_codigo.
+    - select múltiple (lista de valores): valor_codigos = [códigos].
+    - selectboxes ({valor: marcado}): valor_codigos = {código: marcado}.
+    """
+    tipo = campo_definido.tipo
+    if tipo in ('select', 'radio') and isinstance(valor, (str, int, float)) and not isinstance(valor, bool):
+        codigo = _codigo_opcion(campo_definido.pk, campo.valor)
+        if codigo is not None and campo.valor == str(valor):
+            campo.valor_codigo = codigo
+
+    elif tipo == 'select' and isinstance(valor, list) and valor and all(isinstance(v, str) for v in valor):
+        codigos = [_codigo_opcion(campo_definido.pk, v) for v in valor]
+        if None not in codigos:
+            campo.valor_codigos = codigos
+
+    elif tipo == 'multi_select' and isinstance(valor, dict) and valor and all(isinstance(v, bool) for v in valor.values()):
+        codigos = {str(_codigo_opcion(campo_definido.pk, k)): v for k, v in valor.items()}
+        if 'None' not in codigos and len(codigos) == len(valor):
+            campo.valor_codigos = codigos
+
+
+def decodificar_opciones(campo_definido_id, codigo, codigos):
+    """
+    Reconstruye (valor, valor_lista) de un CampoRespuesta codificado (inverso de codificar_opciones).
+    """
+    diccionario = diccionario_opciones(campo_definido_id)
+    usados = [codigo] if codigo is not None else [int(c) for c in codigos] if isinstance(codigos, dict) else list(codigos)
+    if any(c not in diccionario['por_codigo'] for c in usados):
+        diccionario = diccionario_opciones(campo_definido_id, recargar=True)
+    por_codigo = diccionario['por_codigo']
+
+    try:
+        if codigo is not None:
+            return por_codigo[codigo], None
+        if isinstance(codigos, dict):
+            seleccion = {por_codigo[int(c)]: marcado for c, marcado in codigos.items()}
+            return json.dumps(seleccion), [seleccion]
+        return json.dumps([por_codigo[c] for c in codigos]), None
+    except KeyError:
+        return '', None
+
+
+def frecuencias_opciones(campo_definido, encuestas=None):
+    """
+    Cuenta las respuestas por opción agrupando por código entero. Las filas sin código (guardadas
+    antes de codificar el campo o con opciones fuera del diccionario) se agrupan por `valor`.
+    Retorna una lista [(etiqueta, total)] ordenada de mayor a menor.
+    """
+    campos = CampoRespuesta.objects.filter(campo_definido=campo_definido)
+    if encuestas is not None:
+        campos = campos.filter(respuesta__encuesta__in=encuestas)
+
+    conteo = Counter(dict(
+        campos.filter(valor_codigo__isnull=False).order_by()
+        .values_list('valor_codigo').annotate(total=Count('id'))
+    ))
+    for codigos in campos.filter(valor_codigos__isnull=False).values_list('valor_codigos', flat=True).iterator():
+        if isinstance(codigos, dict):
+            conteo.update(int(c) for c, marcado in codigos.items() if marcado)
+        else:
+            conteo.update(codigos)
+
+    opciones = OpcionCampo.objects.filter(campo_definido=campo_definido).values_list('codigo', 'valor', 'etiqueta')
+    etiquetas, codigos_por_valor = {}, {}
+    for codigo, valor, etiqueta in opciones:
+        etiquetas[codigo] = etiqueta
+        codigos_por_valor[valor] = codigo
+
+    sin_codigo = campos.filter(valor_codigo__isnull=True, valor_codigos__isnull=True).exclude(valor='')
+    for valor, total in sin_codigo.order_by().values_list('valor').annotate(total=Count('id')):
+        seleccion = valor_desde_texto(valor)
+        if isinstance(seleccion, dict):
+            seleccion = [opcion for opcion, marcada in seleccion.items() if marcada]
+        elif not isinstance(seleccion, list):
+            seleccion = [seleccion]
+        for opcion in seleccion:
+            opcion = valor_a_texto(opcion)
+            conteo[codigos_por_valor.get(opcion, opcion)] += total
+
+    return [(etiquetas.get(clave, clave), total) for clave, total in conteo.most_common()]
+
+
+def valor_a_texto(valor):
+    """
+    Convierte el valor enviado por Formio a la representación de texto de CampoRespuesta.valor.
+    """
+    if isinstance(valor, (dict, list)):
+        return json.dumps(valor)
+    elif isinstance(valor, str):
+        return valor.strip()
+    return str(valor)
+
+
+def tipar_campo_respuesta(campo, campo_definido, valor):
+    """
+    Asigna el valor original y las columnas tipadas de un CampoRespuesta según el tipo
+    lógico del CampoDefinido. Lanza una excepción si el valor no puede convertirse.
+    """
+    valor_str = valor_a_texto(valor)
+    campo.valor = valor_str
+
+    # Reset de valores tipados
+    for nombre in CAMPOS_TIPADOS:
+        setattr(campo, nombre, None)
+
+    tipo = campo_definido.tipo
+
+    if tipo == 'number':
+        campo.valor_numerico = float(valor_str.replace(",", "."))
+
+    elif tipo == 'date':
+        try:
+            campo.valor_fecha = datetime.strptime(valor_str[:10], "%Y-%m-%d").date()
+        except ValueError:
+            campo.valor_fecha = datetime.strptime(valor_str[:10], "%m/%d/%Y").date()
+
+    elif tipo == 'time':
+        t = datetime.strptime(valor_str[:8], "%H:%M:%S").time()
+        campo.valor_time = t
+        campo.valor_numerico = t.hour * 3600 + t.minute * 60 + t.second
+
+    elif tipo == 'datetime':
+        campo.valor_datetime = datetime.fromisoformat(valor_str)
+
+    elif tipo == 'boolean':
+        if isinstance(valor, bool):
+            campo.valor_booleano = valor
+        elif valor_str.lower() in ['true', '1', 'sí', 'si']:
+            campo.valor_booleano = True
+        elif valor_str.lower() in ['false', '0', 'no']:
+            campo.valor_booleano = False
+        else:
+            raise ValueError(f"Valor booleano inválido: {valor_str}")
+
+    elif tipo in ['multi_select', 'selectboxes', 'checkboxes']:
+        if isinstance(valor, list):
+            campo.valor_lista = valor
+        elif isinstance(valor, str) and ',' in valor:
+            campo.valor_lista = [v.strip() for v in valor.split(',')]
+        else:
+            campo.valor_lista = [valor]
+
+    if tipo in TIPOS_OPCIONES:
+        codificar_opciones(campo, campo_definido, valor)
+
+    return campo
+
+
+def programar_retipado(campo_definido, tipo_anterior):
+    """
+    Crea una TareaRetipado para el campo si tiene respuestas guardadas, reemplazando
+    las tareas pendientes anteriores (la nueva recorre todas las respuestas desde el inicio).
+    """
+    if not CampoRespuesta.objects.filter(campo_definido=campo_definido).exists():
+        return None
+
+    TareaRetipado.objects.filter(campo_definido=campo_definido, completada=False).update(completada=True)
+    return TareaRetipado.objects.create(
+        campo_definido=campo_definido,
+        tipo_anterior=tipo_anterior,
+        tipo_nuevo=campo_definido.tipo,
+    )
+
+
 def guardar_o_actualizar_campos_respuesta(respuesta, respuestas):
-    campos_definidos = CampoDefinido.objects.filter(formulario=respuesta.encuesta.formulario)
+    """
+    Guarda o actualiza los valores respondidos según el almacenamiento del formulario:
+    - 'eav': un CampoRespuesta por campo respondido.
+    - 'documento': el envío completo en RespuestaEncuesta.datos y solo los campos
+      marcados como `indexado` proyectados a CampoRespuesta.
+    Una respuesta con `datos` de un formulario que pasó a 'eav' se convierte a filas al guardarla.
+    `respuestas` puede ser un dict o un iterable de pares (clave, valor), p. ej. envios.EnvioJSON.pares(),
+    que se consume a medida que se lee el envío.
+    """
+    formulario = respuesta.encuesta.formulario
+    documento = formulario.almacenamiento == Formulario.ALMACENAMIENTO_DOCUMENTO
+    campos_definidos = CampoDefinido.objects.filter(formulario=formulario)
     campos_dict = {c.clave: c for c in campos_definidos}
     errores = {}
 
+    if documento:
+        # Se parte del envío anterior (o de las filas EAV si la respuesta aún no está en documento)
+        datos = obtener_datos_respuesta(respuesta, resolver=False)
+
     # Relacionar campos existentes con CampoDefinido (usando clave)
     campos_existentes = {
         c.campo_definido: c for c in respuesta.campos.select_related('campo_definido').all()
         if c.campo_definido  # Asegurar que el campo tenga FK asignada
     }
+    guardados = {campo_definido.clave: campo for campo_definido, campo in campos_existentes.items()}
 
-    for clave, valor in respuestas.items():
+    tipados = {}
+    pares = respuestas.items() if isinstance(respuestas, dict) else respuestas
+    for clave, valor in pares:
         campo_definido = campos_dict.get(clave)
         if not campo_definido:
             continue  # Ignorar campos no definidos o internos
 
-        # Convertir el valor a string seguro
-        if isinstance(valor, (dict, list)):
-            valor_str = json.dumps(valor)
-        elif isinstance(valor, str):
-            valor_str = valor.strip()
-        else:
-            valor_str = str(valor)
-
         campo = campos_existentes.get(campo_definido, CampoRespuesta(
             respuesta=respuesta,
-            campo_definido=campo_definido,
-            clave=campo_definido.clave
+            campo_definido=campo_definido
         ))
 
-        campo.etiqueta = campo_definido.etiqueta
-        campo.valor = valor_str
+        try:
+            tipar_campo_respuesta(campo, campo_definido, valor)
+            tipados[clave] = (campo, valor)
+        except Exception as e:
+            errores[clave] = f"Error en tipo {campo_definido.tipo} con valor '{valor}': {str(e)}"
+
+    if not documento and respuesta.datos is not None:
+        # Respuesta guardada como documento antes de cambiar a 'eav': los campos que no llegan en
+        # este envío ni tienen fila se pasan a CampoRespuesta, y `datos` deja de usarse
+        for clave, valor in respuesta.datos.items():
+            campo_definido = campos_dict.get(clave)
+            if not campo_definido or clave in tipados or clave in guardados:
+                continue
+            campo = CampoRespuesta(respuesta=respuesta, campo_definido=campo_definido)
+            try:
+                tipar_campo_respuesta(campo, campo_definido, valor)
+            except Exception:
+                pass  # Como en ejecutar_tarea_retipado, se conserva el valor sin columnas tipadas
+            tipados[clave] = (campo, valor)
+
+    ocultas = set()
+    if formulario.limpiar_ocultos:
+        # La visibilidad se evalúa una vez sobre el estado completo de la respuesta (anterior + enviado)
+        estado = dict(guardados)
+        estado.update({clave: campo for clave, (campo, _) in tipados.items()})
+        ocultas = claves_ocultas(campos_dict, estado, datos if documento else None)
+
+    for clave, (campo, valor) in tipados.items():
+        if clave in ocultas:
+            continue
+        campo_definido = campos_dict[clave]
 
-        # Reset de valores tipados
-        campo.valor_numerico = None
-        campo.valor_fecha = None
-        campo.valor_time = None
-        campo.valor_datetime = None
-        campo.valor_booleano = None
-        campo.valor_lista = None
+        if documento:
+            datos[clave] = valor
+            if not campo_definido.indexado:
+                continue
 
-        tipo = campo_definido.tipo
+        try:
+            campo.save()
+            guardados[clave] = campo
+        except Exception as e:
+            errores[clave] = f"Error en tipo {campo_definido.tipo} con valor '{valor}': {str(e)}"
+
+    if ocultas:
+        for clave in ocultas:
+            guardados.pop(clave, None)
+            if documento:
+                datos.pop(clave, None)
+        respuesta.campos.filter(campo_definido__clave__in=ocultas).delete()
+
+    if documento:
+        respuesta.datos = datos
+        respuesta.save(update_fields=['datos'])
+        # Las filas de campos no indexados ya viven en el documento
+        respuesta.campos.exclude(campo_definido__indexado=True).delete()
+        snapshot = dict(datos)
+    else:
+        if respuesta.datos is not None:
+            respuesta.datos = None
+            respuesta.save(update_fields=['datos'])
+        snapshot = {clave: valor_desde_texto(campo.valor) for clave, campo in guardados.items()}
+
+    # El snapshot cacheado se reemplaza solo cuando la transacción confirma
+    clave_cache = _clave_snapshot(respuesta.pk)
+    if errores:
+        transaction.on_commit(lambda: cache.delete(clave_cache))
+    else:
+        transaction.on_commit(lambda: cache.set(clave_cache, snapshot, _timeout_snapshot()))
 
+    return errores
+
+
+def obtener_datos_respuesta(respuesta, resolver=True):
+    """
+    Devuelve el envío de una respuesta como dict {clave: valor} listo para Formio,
+    independientemente del almacenamiento usado. Con resolver=False se conservan las
+    referencias a los textos archivados (envios.archivar_grandes) en lugar de su contenido.
+    """
+    if respuesta.datos is not None:
+        datos = dict(respuesta.datos)
+    else:
+        datos = {campo.clave: valor_desde_texto(campo.valor) for campo in respuesta.campos.all()}
+
+    return resolver_archivados(datos) if resolver else datos
+
+
+def resolver_texto_archivado(texto):
+    """
+    Reemplaza en un valor en texto (como CampoRespuesta.valor) las referencias a textos archivados
+    por su contenido.
+    """
+    if not isinstance(texto, str) or PREFIJO_ARCHIVADO not in texto:
+        return texto
+    valor = resolver_archivados(valor_desde_texto(texto))
+    return valor if isinstance(valor, str) else json.dumps(valor)
+
+
+def _clave_snapshot(respuesta_id):
+    return f'custom_forms:snapshot:{respuesta_id}'
+
+
+def _timeout_snapshot():
+    return getattr(settings, 'CUSTOM_FORMS_SNAPSHOT_TIMEOUT', 60 * 60 * 24)
+
+
+def obtener_snapshot_respuesta(respuesta):
+    """
+    Devuelve el envío de la respuesta ({clave: valor} para Formio) desde la caché, construyéndolo
+    con obtener_datos_respuesta si no está. Se reemplaza al guardar la respuesta.
+    Los textos archivados quedan como referencias: se resuelven con resolver_archivados al mostrarlo.
+    Si falta, se construye siempre desde la base primaria (ver _respuestas_para_snapshot), aunque
+    `respuesta` se haya leído de la réplica.
+    """
+    clave = _clave_snapshot(respuesta.pk)
+    snapshot = cache.get(clave)
+    if snapshot is None:
+        primaria = _respuestas_para_snapshot([respuesta.pk]).first()
+        if primaria is None:
+            return obtener_datos_respuesta(respuesta, resolver=False)
+        snapshot = obtener_datos_respuesta(primaria, resolver=False)
+        cache.set(clave, snapshot, _timeout_snapshot())
+    return snapshot
+
+
+def _respuestas_para_snapshot(ids):
+    """
+    Respuestas (con sus campos) leídas de la base primaria. Un snapshot construido desde una réplica
+    atrasada quedaría cacheado hasta su timeout, porque la invalidación ya ocurrió al confirmar.
+    """
+    return RespuestaEncuesta.objects.using(DEFAULT_DB_ALIAS).filter(pk__in=ids).prefetch_related(
+        Prefetch('campos', queryset=CampoRespuesta.objects.using(DEFAULT_DB_ALIAS))
+    )
+
+
+def precargar_snapshots(ids):
+    """
+    Deja en caché los snapshots de las respuestas indicadas (p. ej. la anterior y la siguiente
+    al revisar resultados) con una sola consulta para las que falten.
+    """
+    ids = [respuesta_id for respuesta_id in ids if respuesta_id]
+    if not ids:
+        return
+    existentes = cache.get_many([_clave_snapshot(respuesta_id) for respuesta_id in ids])
+    faltantes = [respuesta_id for respuesta_id in ids if _clave_snapshot(respuesta_id) not in existentes]
+    if not faltantes:
+        return
+    respuestas = _respuestas_para_snapshot(faltantes)
+    cache.set_many(
+        {_clave_snapshot(respuesta.pk): obtener_datos_respuesta(respuesta, resolver=False) for respuesta in respuestas},
+        _timeout_snapshot()
+    )
+
+
+def respuestas_adyacentes(respuesta):
+    """
+    Devuelve (id anterior, id siguiente) de la respuesta dentro de su encuesta, en el mismo orden
+    que la tabla de resultados (-enviado, -id): la anterior es la fila de arriba.
+    """
+    hermanas = RespuestaEncuesta.objects.filter(encuesta_id=respuesta.encuesta_id)
+    enviado = respuesta.enviado
+    anterior = hermanas.filter(
+        Q(enviado__gt=enviado) | Q(enviado=enviado, id__gt=respuesta.pk)
+    ).order_by('enviado', 'id').values_list('id', flat=True).first()
+    siguiente = hermanas.filter(
+        Q(enviado__lt=enviado) | Q(enviado=enviado, id__lt=respuesta.pk)
+    ).order_by('-enviado', '-id').values_list('id', flat=True).first()
+    return anterior, siguiente
+
+
+def invalidar_snapshot(respuesta_id):
+    """
+    Elimina de la caché el snapshot de la respuesta cuando la transacción actual confirma.
+    """
+    clave = _clave_snapshot(respuesta_id)
+    transaction.on_commit(lambda: cache.delete(clave))
+
+
+def obtener_schema_version(formulario_id, numero):
+    """
+    Devuelve el schema Formio con el que se respondió una versión (o el actual si no hay
+    FormularioVersion), cacheado por (formulario, versión).
+    """
+    clave = f'custom_forms:schema:{formulario_id}:{numero}'
+    schema = cache.get(clave)
+    if schema is None:
+        schema = FormularioVersion.objects.filter(formulario_id=formulario_id, numero=numero).values_list('json', flat=True).first()
+        if schema is None:
+            schema = Formulario.objects.filter(pk=formulario_id).values_list('json', flat=True).first()
+        cache.set(clave, schema, _timeout_snapshot())
+    return schema
+
+
+def invalidar_schema_version(formulario_id, numeros):
+    cache.delete_many(
+        [f'custom_forms:schema:{formulario_id}:{numero}' for numero in numeros] +
+        [f'custom_forms:etiquetas:{formulario_id}:{numero}' for numero in numeros]
+    )
+
+
+def etiquetas_version(formulario_id, numero):
+    """
+    Devuelve {clave: etiqueta} según el schema de una versión del formulario, cacheado por (formulario, versión).
+    """
+    clave = f'custom_forms:etiquetas:{formulario_id}:{numero}'
+    etiquetas = cache.get(clave)
+    if etiquetas is None:
+        schema = obtener_schema_version(formulario_id, numero) or {}
+        etiquetas = {comp['key']: comp['label'] for comp in extraer_componentes(schema)}
+        cache.set(clave, etiquetas, _timeout_snapshot())
+    return etiquetas
+
+
+# Memoria local {campo_definido_id: clave}. La clave de un CampoDefinido no cambia nunca
+# (sincronizar_campos_definidos empareja por clave), así que no hace falta invalidarla.
+_claves_campos = {}
+
+
+def clave_campo_definido(campo_definido_id):
+    """
+    Devuelve la clave de un CampoDefinido; ante un id desconocido carga de una vez todas las claves de su formulario.
+    """
+    if campo_definido_id not in _claves_campos:
+        _claves_campos.update(
+            CampoDefinido.objects.filter(formulario__campodefinido__id=campo_definido_id).values_list('id', 'clave')
+        )
+    return _claves_campos.get(campo_definido_id)
+
+
+def etiqueta_campo_respuesta(campo):
+    """
+    Etiqueta histórica de un CampoRespuesta: la del schema de la versión respondida o, si la
+    clave no aparece en él, la etiqueta actual del CampoDefinido.
+    """
+    respuesta = campo.respuesta
+    etiquetas = etiquetas_version(respuesta.encuesta.formulario_id, respuesta.version)
+    return etiquetas.get(campo.clave) or campo.campo_definido.etiqueta
+
+
+def obtener_valores_respuesta(respuesta):
+    """
+    Devuelve un dict {clave: valor en texto} de la respuesta, como en CampoRespuesta.valor,
+    con los textos archivados resueltos.
+    """
+    if respuesta.datos is not None:
+        return {clave: valor_a_texto(resolver_archivados(valor)) for clave, valor in respuesta.datos.items()}
+
+    return {campo.clave: resolver_texto_archivado(campo.valor) for campo in respuesta.campos.all()}
+
+
+def valores_tabla_respuestas(respuestas, campos):
+    """
+    Devuelve {respuesta_id: {clave: valor en texto}} solo para los CampoDefinido de `campos`
+    (p. ej. las columnas `table_view`), con una única consulta restringida por campo_definido_id.
+    """
+    claves = {campo.id: campo.clave for campo in campos}
+    resultado = {}
+    ids_eav = []
+
+    for respuesta in respuestas:
+        if respuesta.datos is None:
+            ids_eav.append(respuesta.id)
+            continue
+        resultado[respuesta.id] = {
+            clave: valor_a_texto(resolver_archivados(respuesta.datos[clave]))
+            for clave in claves.values() if clave in respuesta.datos
+        }
+
+    if ids_eav and claves:
+        filas = CampoRespuesta.objects.filter(
+            respuesta_id__in=ids_eav,
+            campo_definido_id__in=claves.keys()
+        ).values_list('respuesta_id', 'campo_definido_id', 'valor', 'valor_codigo', 'valor_codigos')
+        for respuesta_id, campo_definido_id, valor, codigo, codigos in filas:
+            if valor == '' and (codigo is not None or codigos is not None):
+                valor, _ = decodificar_opciones(campo_definido_id, codigo, codigos)
+            resultado.setdefault(respuesta_id, {})[claves[campo_definido_id]] = resolver_texto_archivado(valor)
+
+    return resultado
+
+
+def obtener_campos_respuesta(respuesta, campos_definidos=None):
+    """
+    Devuelve un dict {clave: CampoRespuesta} con las columnas tipadas de la respuesta.
+    En almacenamiento 'documento' los CampoRespuesta se construyen en memoria (no se guardan).
+    campos_definidos es un dict opcional {clave: CampoDefinido} para evitar consultarlo por respuesta.
+    """
+    if respuesta.datos is None:
+        return {c.clave: c for c in respuesta.campos.all()}
+
+    if campos_definidos is None:
+        campos_definidos = {
+            c.clave: c for c in CampoDefinido.objects.filter(formulario_id=respuesta.encuesta.formulario_id)
+        }
+
+    campos = {}
+    for clave, valor in respuesta.datos.items():
+        campo_definido = campos_definidos.get(clave)
+        if not campo_definido:
+            continue
+
+        campo = CampoRespuesta(respuesta=respuesta, campo_definido=campo_definido)
         try:
-            if tipo == 'number':
-                campo.valor_numerico = float(valor_str.replace(",", "."))
+            tipar_campo_respuesta(campo, campo_definido, valor)
+        except Exception:
+            pass  # Se conserva el valor original sin tipar
+        campos[clave] = campo
 
-            elif tipo == 'date':
-                try:
-                    campo.valor_fecha = datetime.strptime(valor_str[:10], "%Y-%m-%d").date()
-                except ValueError:
-                    campo.valor_fecha = datetime.strptime(valor_str[:10], "%m/%d/%Y").date()
-
-            elif tipo == 'time':
-                t = datetime.strptime(valor_str[:8], "%H:%M:%S").time()
-                campo.valor_time = t
-                campo.valor_numerico = t.hour * 3600 + t.minute * 60 + t.second
-
-            elif tipo == 'datetime':
-                campo.valor_datetime = datetime.fromisoformat(valor_str)
-
-            elif tipo == 'boolean':
-                if isinstance(valor, bool):
-                    campo.valor_booleano = valor
-                elif valor_str.lower() in ['true', '1', 'sí', 'si']:
-                    campo.valor_booleano = True
-                elif valor_str.lower() in ['false', '0', 'no']:
-                    campo.valor_booleano = False
-                else:
-                    raise ValueError(f"Valor booleano inválido: {valor_str}")
+    return campos
 
-            elif tipo in ['multi_select', 'selectboxes', 'checkboxes']:
-                if isinstance(valor, list):
-                    campo.valor_lista = valor
-                elif isinstance(valor, str) and ',' in valor:
-                    campo.valor_lista = [v.strip() for v in valor.split(',')]
-                else:
-                    campo.valor_lista = [valor]
 
-            campo.save()
+def claves_ocultas(campos_definidos, campos_respuesta, datos=None):
+    """
+    Devuelve las claves de los campos ocultos por su `conditional` cuya respuesta no debe guardarse
+    (los que tienen `validate_when_hidden` se conservan).
+    campos_definidos es un dict {clave: CampoDefinido} y campos_respuesta {clave: CampoRespuesta}.
+    En almacenamiento 'documento' se pasa `datos` para tipar en memoria los campos de referencia sin fila.
+    Como en Formio, un campo oculto no cuenta como respondido para las condiciones que dependen de él,
+    así que se reevalúa hasta que el conjunto de ocultos no cambia.
+    """
+    condicionales = [
+        c for c in campos_definidos.values()
+        if isinstance(c.conditional, dict) and c.conditional.get('when')
+    ]
+    if not condicionales:
+        return set()
+
+    campos_respuesta = dict(campos_respuesta)
+    if datos:
+        for clave in {c.conditional['when'] for c in condicionales}:
+            campo_definido = campos_definidos.get(clave)
+            if clave in campos_respuesta or clave not in datos or not campo_definido:
+                continue
+            campo = CampoRespuesta(campo_definido=campo_definido)
+            try:
+                tipar_campo_respuesta(campo, campo_definido, datos[clave])
+            except Exception:
+                pass  # Se evalúa con el valor original sin tipar
+            campos_respuesta[clave] = campo
 
-        except Exception as e:
-            errores[clave] = f"Error en tipo {tipo} con valor '{valor}': {str(e)}"
+    ocultas = set()
+    for _ in range(len(condicionales) + 1):
+        visibles = {clave: campo for clave, campo in campos_respuesta.items() if clave not in ocultas}
+        nuevas = {c.clave for c in condicionales if not condicion_cumplida(c, visibles)}
+        if nuevas == ocultas:
+            break
+        ocultas = nuevas
 
-    return errores
+    return {clave for clave in ocultas if not campos_definidos[clave].validate_when_hidden}
 
 
 def normalizar_json(schema):
@@ -428,8 +981,8 @@ def guardar_respuesta_en_modelo_desde_respuesta(
     extras=None,
     validar=False
 ):
-    campos_respuesta = {c.clave: c for c in respuesta_obj.campos.all()}
     campos_definidos = CampoDefinido.objects.filter(formulario=respuesta_obj.encuesta.formulario, activo=True)
+    campos_respuesta = obtener_campos_respuesta(respuesta_obj)
 
     campos_condicionales_visibles_no_respondidos = []
 
@@ -469,7 +1022,7 @@ def guardar_respuesta_en_modelo_desde_respuesta(
         if isinstance(f, models.Field) and not f.auto_created
     }
 
-    for campo_resp in respuesta_obj.campos.all():
+    for campo_resp in campos_respuesta.values():
         raw_key = campo_resp.clave
         attr = camel_to_snake(raw_key)
 
@@ -489,10 +1042,11 @@ def guardar_respuesta_en_modelo_desde_respuesta(
         elif campo_resp.valor_lista not in (None, []):
             valor = campo_resp.valor_lista
         else:
+            texto = resolver_texto_archivado(campo_resp.valor)
             try:
-                valor = json.loads(campo_resp.valor)
+                valor = json.loads(texto)
             except Exception:
-                valor = campo_resp.valor
+                valor = texto
 
         try:
             setattr(obj, attr, valor)
@@ -510,53 +1064,681 @@ def guardar_respuesta_en_modelo_desde_respuesta(
 
 
 
-def actualizar_formulario_y_guardar_version(formulario, nuevo_json: dict) -> bool:
+def actualizar_formulario_y_guardar_version(formulario, nuevo_json: dict, campos=()) -> bool:
     """
-    Actualiza el JSON de un formulario y guarda una nueva versión
-    solo si ya existen respuestas y el esquema cambió.
+    Actualiza el JSON de un formulario y guarda una nueva versión si el esquema cambió.
+    `campos` son los demás campos editados de `formulario` que también deben guardarse
+    (p. ej. los del FormularioForm); el resto de columnas no se escribe.
     Retorna True si se creó una nueva versión, False si no fue necesario.
-    """
-    from .utils import normalizar_json
 
+    Todo ocurre en una transacción que bloquea la fila del Formulario (select_for_update), de modo
+    que las ediciones concurrentes se serializan. Los envíos no se bloquean: leen la versión sin
+    bloqueo y pueden confirmarse después de la edición con el número anterior, así que el schema
+    de una versión nunca se sobrescribe: todo cambio de esquema crea una versión nueva.
+    """
     schema_nuevo = normalizar_json(nuevo_json)
-    schema_actual = normalizar_json(formulario.json)
+    campos = [campo for campo in campos if campo not in ('json', 'version')]
+
+    with transaction.atomic():
+        actual = Formulario.objects.select_for_update().only('json', 'version').get(pk=formulario.pk)
+        # Partir siempre de la versión confirmada, no de la leída antes del bloqueo
+        version_actual = actual.version
+        json_anterior = actual.json
+
+        # Si no hay cambios en el JSON, solo se guardan los demás campos editados
+        if schema_nuevo == normalizar_json(json_anterior):
+            formulario.json = json_anterior
+            formulario.version = version_actual
+            if campos:
+                formulario.save(update_fields=campos)
+            return False
+
+        # Las respuestas ya enviadas (o en curso) con la versión actual conservan su schema
+        FormularioVersion.objects.get_or_create(
+            formulario=formulario,
+            numero=version_actual,
+            defaults={'json': json_anterior}
+        )
 
-    # Si no hay cambios en el JSON, no hacemos nada
-    if schema_nuevo == schema_actual:
-        return False
+        nueva_version = version_actual + 1
+        FormularioVersion.objects.create(
+            formulario=formulario,
+            numero=nueva_version,
+            json=nuevo_json
+        )
+        formulario.json = nuevo_json
+        formulario.version = nueva_version
+        formulario.save(update_fields=['json', 'version'] + campos)
+        transaction.on_commit(lambda: invalidar_schema_version(formulario.pk, [version_actual, nueva_version]))
+        return True
 
-    # Guardamos el nuevo JSON
-    formulario.json = nuevo_json
-    formulario.save()
 
-    ultima = FormularioVersion.objects.filter(formulario=formulario).order_by('-numero').first()
-    schema_ultimo = normalizar_json(ultima.json) if ultima else None
+def _generacion_visibilidad(formulario_id):
+    return (
+        cache.get('custom_forms:visibilidad:gen', 0),
+        cache.get(f'custom_forms:visibilidad:gen:{formulario_id}', 0),
+    )
 
-    # Si es igual al último esquema guardado, no hace falta crear una nueva versión
-    if schema_nuevo == schema_ultimo:
-        return False
 
-    # Verifica si existen respuestas que ya usan la versión actual
-    tiene_respuestas = RespuestaEncuesta.objects.filter(
-        encuesta__formulario=formulario,
-        version=formulario.version
-    ).exists()
-
-    if not tiene_respuestas:
-        # Solo actualiza la última versión
-        if ultima:
-            ultima.json = nuevo_json
-            ultima.save()
-        return False
+def invalidar_visibilidad(formulario_id=None):
+    """
+    Invalida los mapas de visibilidad cacheados de un formulario (o de todos si formulario_id es None).
+    La generación avanza al confirmar la transacción: antes, otra petición podría reconstruir el mapa
+    con los datos aún sin confirmar y cachearlo bajo la generación nueva.
+    """
+    clave = 'custom_forms:visibilidad:gen' if formulario_id is None else f'custom_forms:visibilidad:gen:{formulario_id}'
+
+    def avanzar():
+        try:
+            cache.incr(clave)
+        except ValueError:
+            cache.set(clave, 1, None)
+
+    transaction.on_commit(avanzar)
+
+
+def grupos_usuario(usuario):
+    """
+    Devuelve el frozenset de ids de grupos del usuario, memorizado en la instancia durante la petición.
+    """
+    if not hasattr(usuario, '_custom_forms_grupos'):
+        if usuario.is_authenticated:
+            usuario._custom_forms_grupos = frozenset(usuario.groups.using(DEFAULT_DB_ALIAS).values_list('id', flat=True))
+        else:
+            usuario._custom_forms_grupos = frozenset()
+    return usuario._custom_forms_grupos
+
+
+def campos_visibles_para(formulario, usuario, version=None):
+    """
+    Devuelve un dict {id: clave} de los CampoDefinido que el usuario puede ver en resultados,
+    o None si puede verlos todos (superusuario).
+    Un campo sin grupos en `visible_para` es visible para todos; con grupos, solo para sus miembros.
+    El mapa se cachea por (formulario, versión, grupos del usuario) y se invalida al cambiar `visible_para`.
+    Las entradas expiran tras CUSTOM_FORMS_VISIBILIDAD_TIMEOUT segundos, porque las invalidadas por una
+    generación anterior ya no se leen y solo así dejan la caché; los contadores de generación no expiran.
+    El mapa se construye siempre desde la base primaria, aunque la vista lea de la réplica: uno construido
+    con una réplica atrasada quedaría cacheado bajo la generación vigente hasta que expire.
+    """
+    if usuario.is_superuser:
+        return None
+
+    grupos = grupos_usuario(usuario)
+    version = formulario.version if version is None else version
+    firma = hashlib.md5(','.join(str(g) for g in sorted(grupos)).encode()).hexdigest()
+    gen_global, gen_formulario = _generacion_visibilidad(formulario.pk)
+    clave = f'custom_forms:visibilidad:{gen_global}:{formulario.pk}:{gen_formulario}:{version}:{firma}'
+
+    visibles = cache.get(clave)
+    if visibles is None:
+        restricciones = {}
+        campos = CampoDefinido.objects.using(DEFAULT_DB_ALIAS).filter(formulario_id=formulario.pk)
+        for campo_id, campo_clave, grupo_id in campos.values_list('id', 'clave', 'visible_para'):
+            _, permitidos = restricciones.setdefault(campo_id, (campo_clave, set()))
+            if grupo_id is not None:
+                permitidos.add(grupo_id)
+
+        visibles = {
+            campo_id: campo_clave
+            for campo_id, (campo_clave, permitidos) in restricciones.items()
+            if not permitidos or permitidos & grupos
+        }
+        cache.set(clave, visibles, getattr(settings, 'CUSTOM_FORMS_VISIBILIDAD_TIMEOUT', 60 * 60))
+
+    return visibles
+
+
+def filtrar_campos_visibles(valores, visibles):
+    """
+    Filtra un dict {clave: valor} dejando solo las claves visibles (ver campos_visibles_para).
+    Con un iterable de pares (clave, valor) devuelve un generador de pares, sin consumirlo.
+    """
+    if visibles is None:
+        return valores
+    claves = set(visibles.values())
+    if not isinstance(valores, dict):
+        return ((clave, valor) for clave, valor in valores if clave in claves)
+    return {clave: valor for clave, valor in valores.items() if clave in claves}
+
+
+def iterar_respuestas_por_lotes(queryset, tamano_lote=500):
+    """
+    Recorre un queryset de RespuestaEncuesta por lotes de id con sus campos precargados,
+    sin cargar todas las respuestas en memoria.
+    """
+    ultimo_id = 0
+    while True:
+        lote = list(queryset.filter(id__gt=ultimo_id).order_by('id').prefetch_related('campos')[:tamano_lote])
+        if not lote:
+            break
+        yield from lote
+        ultimo_id = lote[-1].id
+
+
+def formularios_vigentes(using=None):
+    """
+    Formularios no marcados con eliminacion_pendiente. Toda búsqueda de un formulario por id debe
+    partir de aquí: uno marcado deja de existir para el usuario aunque sus filas aún se estén purgando.
+    """
+    return Formulario.objects.using(using).filter(eliminacion_pendiente=False)
 
-    # Si hay respuestas, crea una nueva versión
-    nueva_version = formulario.version + 1
-    FormularioVersion.objects.create(
-        formulario=formulario,
-        numero=nueva_version,
-        json=nuevo_json
+
+def encuestas_vigentes(using=None):
+    """
+    Encuestas no marcadas con eliminacion_pendiente ni de un formulario marcado.
+    """
+    return Encuesta.objects.using(using).filter(eliminacion_pendiente=False, formulario__eliminacion_pendiente=False)
+
+
+def respuestas_vigentes(using=None):
+    """
+    Respuestas de encuestas vigentes (ver encuestas_vigentes).
+    """
+    return RespuestaEncuesta.objects.using(using).filter(
+        encuesta__eliminacion_pendiente=False, encuesta__formulario__eliminacion_pendiente=False
     )
-    formulario.version = nueva_version
-    formulario.save(update_fields=['version'])
-    return True
 
+
+def _eliminar_dependientes_raw(cursor, modelo, ids):
+    """
+    Elimina (o desvincula) con SQL directo las filas que referencian a `ids` de `modelo`,
+    siguiendo el on_delete de cada relación inversa. Solo recorre un nivel.
+    """
+    marcadores = ', '.join(['%s'] * len(ids))
+    for relacion in modelo._meta.related_objects:
+        if not relacion.one_to_many:
+            continue
+        tabla = connection.ops.quote_name(relacion.related_model._meta.db_table)
+        columna = connection.ops.quote_name(relacion.field.column)
+        if relacion.on_delete is models.CASCADE:
+            cursor.execute(f"DELETE FROM {tabla} WHERE {columna} IN ({marcadores})", ids)
+        elif relacion.on_delete is models.SET_NULL:
+            cursor.execute(f"UPDATE {tabla} SET {columna} = NULL WHERE {columna} IN ({marcadores})", ids)
+
+
+def _eliminar_filas_por_lotes(modelo, campo, valor, tamano_lote):
+    """
+    Elimina con SQL directo, en lotes de `tamano_lote` ids y una transacción por lote, las filas
+    de `modelo` (sin relaciones inversas) cuyo `campo` es `valor`.
+    """
+    tabla = connection.ops.quote_name(modelo._meta.db_table)
+    columna = connection.ops.quote_name(modelo._meta.get_field(campo).column)
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"SELECT id FROM {tabla} WHERE {columna} = %s ORDER BY id LIMIT %s", [valor, tamano_lote])
+            ids = [fila[0] for fila in cursor.fetchall()]
+            if not ids:
+                return
+            cursor.execute(f"DELETE FROM {tabla} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+
+
+def eliminar_encuesta_por_lotes(encuesta, tamano_lote=1000, progreso=None):
+    """
+    Elimina una encuesta y sus respuestas en lotes acotados con SQL directo, sin que el
+    collector de Django cargue todas las RespuestaEncuesta/CampoRespuesta en memoria.
+    Los eventos del outbox, los sketches pendientes y los resúmenes por hora (una fila por
+    envío o por hora) se purgan del mismo modo. Cada lote se ejecuta en su propia transacción para no bloquear
+    las tablas. `progreso(encuesta, eliminadas, total)` se invoca tras cada lote.
+    """
+    tabla = connection.ops.quote_name(RespuestaEncuesta._meta.db_table)
+    columna = connection.ops.quote_name(RespuestaEncuesta._meta.get_field('encuesta').column)
+    total = RespuestaEncuesta.objects.filter(encuesta_id=encuesta.pk).count()
+    bloqueo = ' FOR UPDATE' if connection.features.has_select_for_update else ''
+    eliminadas = 0
+
+    while True:
+        with transaction.atomic(), connection.cursor() as cursor:
+            # Bloquear el lote antes de borrar sus filas: una edición en curso termina antes (o no encuentra
+            # la respuesta), y no puede insertar CampoRespuesta entre los dos DELETE
+            cursor.execute(
+                f"SELECT id FROM {tabla} WHERE {columna} = %s ORDER BY id LIMIT %s{bloqueo}", [encuesta.pk, tamano_lote]
+            )
+            ids = [fila[0] for fila in cursor.fetchall()]
+            if not ids:
+                break
+            _eliminar_dependientes_raw(cursor, RespuestaEncuesta, ids)
+            cursor.execute(f"DELETE FROM {tabla} WHERE id IN ({', '.join(['%s'] * len(ids))})", ids)
+
+        eliminadas += len(ids)
+        if progreso:
+            progreso(encuesta, eliminadas, total)
+
+    _eliminar_filas_por_lotes(EventoSalida, 'encuesta', encuesta.pk, tamano_lote)
+    _eliminar_filas_por_lotes(SketchPendiente, 'encuesta', encuesta.pk, tamano_lote)
+    _eliminar_filas_por_lotes(ResumenEnvios, 'encuesta', encuesta.pk, tamano_lote)
+
+    # Sin respuestas, eventos ni resúmenes, el borrado en cascada restante es pequeño
+    encuesta.delete()
+    return eliminadas
+
+
+def eliminar_formulario_por_lotes(formulario, tamano_lote=1000, progreso=None):
+    """
+    Elimina un formulario purgando primero por lotes las respuestas de todas sus encuestas.
+    """
+    eliminadas = 0
+    for encuesta in Encuesta.objects.filter(formulario=formulario):
+        eliminadas += eliminar_encuesta_por_lotes(encuesta, tamano_lote, progreso)
+    formulario.delete()
+    return eliminadas
+
+
+def referencias_archivadas(tamano_lote=1000):
+    """
+    Nombres en default_storage de los textos archivados que referencia alguna respuesta
+    (en CampoRespuesta.valor o en RespuestaEncuesta.datos).
+    """
+    nombres = set()
+    textos = CampoRespuesta.objects.filter(valor__contains=PREFIJO_ARCHIVADO).values_list('valor', flat=True)
+    documentos = RespuestaEncuesta.objects.annotate(texto=Cast('datos', models.TextField())).filter(
+        texto__contains=PREFIJO_ARCHIVADO
+    ).values_list('texto', flat=True)
+    for texto in textos.iterator(chunk_size=tamano_lote):
+        nombres.update(REFERENCIA_ARCHIVADO.findall(texto))
+    for texto in documentos.iterator(chunk_size=tamano_lote):
+        nombres.update(REFERENCIA_ARCHIVADO.findall(texto))
+    return nombres
+
+
+def purgar_archivados(antiguedad, simular=False):
+    """
+    Elimina de default_storage los textos archivados que ninguna respuesta referencia (de envíos
+    fallidos, ediciones que los reemplazaron o respuestas eliminadas) y cuya última modificación es
+    anterior a `antiguedad` (timedelta). Cada archivo lo referencia solo el envío que lo creó, así que
+    la antigüedad mínima protege a los envíos aún en curso. Retorna los nombres eliminados.
+    """
+    limite = datetime.now(timezone.utc) - antiguedad
+    referenciados = referencias_archivadas()
+    directorio = directorio_archivados()
+    try:
+        _, archivos = default_storage.listdir(directorio)
+    except FileNotFoundError:
+        return []  # Aún no se archivó ningún texto: FileSystemStorage no crea el directorio hasta entonces
+
+    eliminados = []
+    for archivo in archivos:
+        nombre = directorio + archivo
+        if nombre in referenciados:
+            continue
+        # Con USE_TZ = False la fecha es naive en hora local: astimezone la interpreta así
+        if default_storage.get_modified_time(nombre).astimezone(timezone.utc) >= limite:
+            continue
+        if not simular:
+            default_storage.delete(nombre)
+        eliminados.append(nombre)
+    return eliminados
+
+
+def valor_desde_texto(valor):
+    """
+    Reconstruye el valor enviado por Formio a partir de CampoRespuesta.valor.
+    """
+    if valor.startswith('[') or valor.startswith('{'):
+        try:
+            return json.loads(valor)
+        except ValueError:
+            pass
+    return valor
+
+
+def ejecutar_tarea_retipado(tarea, tamano_lote=1000, max_errores=100, progreso=None):
+    """
+    Vuelve a calcular las columnas tipadas de las respuestas de un campo en lotes ordenados por id.
+    Cada lote se lee bloqueado (select_for_update) y se guarda con bulk_update en la misma transacción
+    corta, junto con el punto de control: una edición concurrente espera al lote en lugar de ser
+    sobrescrita con el valor leído antes. La tarea puede reanudarse si se interrumpe y se detiene
+    si fue reemplazada.
+    """
+    campo_definido = tarea.campo_definido
+
+    while True:
+        tarea.refresh_from_db(fields=['completada'])
+        if tarea.completada:
+            break
+        campo_definido.refresh_from_db(fields=['tipo'])
+
+        with transaction.atomic():
+            lote = list(
+                CampoRespuesta.objects.select_for_update()
+                .filter(campo_definido=campo_definido, id__gt=tarea.ultimo_id).order_by('id')[:tamano_lote]
+            )
+            if not lote:
+                tarea.completada = True
+                tarea.save(update_fields=['completada'])
+                break
+
+            errores = []
+            for campo in lote:
+                valor = campo.valor
+                try:
+                    tipar_campo_respuesta(campo, campo_definido, valor_desde_texto(valor))
+                except Exception as e:
+                    # tipar_campo_respuesta ya limpió las columnas tipadas obsoletas
+                    errores.append({'id': campo.id, 'valor': valor[:200], 'error': str(e)})
+                campo.valor = valor
+                # bulk_update no pasa por save(): aplicar la forma compacta de las opciones codificadas
+                campo.valor, campo.valor_lista = campo.valores_persistidos()
+
+            CampoRespuesta.objects.bulk_update(lote, CAMPOS_TIPADOS + ['valor'])
+            tarea.ultimo_id = lote[-1].id
+            tarea.procesados += len(lote)
+            tarea.no_convertibles += len(errores)
+            tarea.errores = (tarea.errores + errores)[:max_errores]
+            tarea.save(update_fields=['ultimo_id', 'procesados', 'no_convertibles', 'errores'])
+
+        if progreso:
+            progreso(tarea, errores)
+
+    return tarea
+
+
+def registrar_envio_en_resumen(respuesta):
+    """
+    Incrementa el contador de ResumenEnvios de la hora en que se envió la respuesta.
+    """
+    intervalo = respuesta.enviado.replace(minute=0, second=0, microsecond=0)
+    filtro = {'encuesta_id': respuesta.encuesta_id, 'version': respuesta.version, 'intervalo': intervalo}
+
+    if ResumenEnvios.objects.filter(**filtro).update(total=F('total') + 1):
+        return
+    try:
+        with transaction.atomic():
+            ResumenEnvios.objects.create(formulario_id=respuesta.encuesta.formulario_id, total=1, **filtro)
+    except IntegrityError:
+        # Otro envío creó la fila en paralelo
+        ResumenEnvios.objects.filter(**filtro).update(total=F('total') + 1)
+
+
+def reconstruir_resumen_envios(encuestas=None, tamano_lote=1000):
+    """
+    Recalcula ResumenEnvios desde RespuestaEncuesta.enviado (todas las encuestas o las indicadas).
+    Retorna el número de filas de resumen creadas.
+    """
+    respuestas = RespuestaEncuesta.objects.all()
+    resumen = ResumenEnvios.objects.all()
+    if encuestas is not None:
+        respuestas = respuestas.filter(encuesta__in=encuestas)
+        resumen = resumen.filter(encuesta__in=encuestas)
+
+    agregados = (
+        respuestas
+        .annotate(intervalo=TruncHour('enviado', tzinfo=timezone.utc))
+        .values('encuesta_id', 'encuesta__formulario_id', 'version', 'intervalo')
+        .annotate(total=Count('id'))
+        .order_by()
+    )
+
+    with transaction.atomic():
+        resumen.delete()
+        filas = [
+            ResumenEnvios(
+                encuesta_id=fila['encuesta_id'],
+                formulario_id=fila['encuesta__formulario_id'],
+                version=fila['version'],
+                intervalo=fila['intervalo'],
+                total=fila['total'],
+            )
+            for fila in agregados
+        ]
+        ResumenEnvios.objects.bulk_create(filas, batch_size=tamano_lote)
+    return len(filas)
+
+
+def envios_por_intervalo(formulario=None, encuesta=None, version=None, desde=None, hasta=None, por_version=False):
+    """
+    Devuelve la serie de envíos por hora leyendo ResumenEnvios (O(intervalos), no O(respuestas)).
+    Con `formulario` se suman todas las encuestas que comparten ese formulario.
+    Retorna una lista de dicts {'intervalo', 'total'} (y 'version' si por_version=True) ordenada por intervalo.
+    """
+    resumen = ResumenEnvios.objects.all()
+    if formulario is not None:
+        resumen = resumen.filter(formulario=formulario)
+    if encuesta is not None:
+        resumen = resumen.filter(encuesta=encuesta)
+    if version is not None:
+        resumen = resumen.filter(version=version)
+    if desde is not None:
+        resumen = resumen.filter(intervalo__gte=desde)
+    if hasta is not None:
+        resumen = resumen.filter(intervalo__lt=hasta)
+
+    campos = ['intervalo', 'version'] if por_version else ['intervalo']
+    return list(resumen.values(*campos).annotate(total=Sum('total')).order_by(*campos))
+
+
+def actualizar_contadores_encuesta(respuesta):
+    """
+    Actualiza los contadores cacheados de la encuesta (total y última respuesta) tras un envío.
+    """
+    Encuesta.objects.filter(pk=respuesta.encuesta_id).update(
+        total_respuestas=F('total_respuestas') + 1,
+        ultima_respuesta=respuesta.enviado,
+    )
+
+
+def recalcular_contadores_encuestas(encuestas=None):
+    """
+    Recalcula total_respuestas y ultima_respuesta desde RespuestaEncuesta con una sola consulta UPDATE.
+    """
+    respuestas = RespuestaEncuesta.objects.filter(encuesta=OuterRef('pk')).order_by().values('encuesta')
+    queryset = Encuesta.objects.all() if encuestas is None else encuestas
+    return queryset.update(
+        total_respuestas=Coalesce(
+            Subquery(respuestas.annotate(total=Count('id')).values('total')), 0, output_field=models.IntegerField()
+        ),
+        ultima_respuesta=Subquery(respuestas.annotate(ultima=Max('enviado')).values('ultima')),
+    )
+
+
+def total_campos_activos_subquery(referencia='pk'):
+    """
+    Subquery con el número de CampoDefinido activos del formulario referenciado por `referencia`.
+    """
+    campos = (
+        CampoDefinido.objects.filter(formulario=OuterRef(referencia), activo=True)
+        .order_by().values('formulario').annotate(total=Count('id')).values('total')
+    )
+    return Coalesce(Subquery(campos), 0, output_field=models.IntegerField())
+
+
+def valor_tipado(campo, tipo):
+    """
+    Valor tipado de un CampoRespuesta para análisis, según el tipo lógico del CampoDefinido.
+    Las horas se expresan en segundos desde medianoche; listas y texto se devuelven como texto.
+    """
+    if tipo in ('number', 'time'):
+        return campo.valor_numerico
+    if tipo == 'date':
+        return campo.valor_fecha
+    if tipo == 'datetime':
+        return campo.valor_datetime
+    if tipo == 'boolean':
+        return campo.valor_booleano
+    return campo.valor
+
+
+def sin_zona(valor):
+    """Convierte datetimes con zona a UTC naive (formato común para Parquet/NumPy/CSV)."""
+    if isinstance(valor, datetime) and valor.tzinfo is not None:
+        return valor.astimezone(timezone.utc).replace(tzinfo=None)
+    return valor
+
+
+def iterar_filas_tipadas(encuesta, campos_definidos, desde_id=0, hasta_id=None, tamano_lote=1000):
+    """
+    Recorre por lotes de id las respuestas de la encuesta con id en (desde_id, hasta_id],
+    devolviendo tuplas (respuesta, {clave: valor tipado}) para los CampoDefinido indicados.
+    """
+    por_clave = {campo.clave: campo for campo in campos_definidos}
+    respuestas = RespuestaEncuesta.objects.filter(encuesta=encuesta, id__gt=desde_id)
+    if hasta_id is not None:
+        respuestas = respuestas.filter(id__lte=hasta_id)
+
+    for respuesta in iterar_respuestas_por_lotes(respuestas, tamano_lote):
+        campos = obtener_campos_respuesta(respuesta, por_clave)
+        yield respuesta, {
+            clave: resolver_texto_archivado(valor_tipado(campo, por_clave[clave].tipo))
+            for clave, campo in campos.items() if clave in por_clave
+        }
+
+
+TIPOS_FRECUENTES = ('text', 'select', 'radio')
+
+
+def _agregar_a_sketches(sketch, valores, tipo):
+    """
+    Agrega a un SketchCampo una lista de (valor, valor_numerico), deserializando sus resúmenes una sola vez.
+    """
+    distintos = HyperLogLog.desde_dict(sketch.distintos)
+    cuantiles = KLL.desde_dict(sketch.cuantiles)
+    frecuentes = EspacioAhorro.desde_dict(sketch.frecuentes)
+    numericos = frecuentados = False
+
+    for valor, valor_numerico in valores:
+        distintos.agregar(valor)
+        if valor_numerico is not None:
+            cuantiles.agregar(valor_numerico)
+            numericos = True
+        if tipo in TIPOS_FRECUENTES and not es_valor_vacio(valor):
+            frecuentes.agregar(valor)
+            frecuentados = True
+        sketch.total += 1
+
+    sketch.distintos = distintos.a_dict()
+    if numericos:
+        sketch.cuantiles = cuantiles.a_dict()
+    if frecuentados:
+        sketch.frecuentes = frecuentes.a_dict()
+
+
+def actualizar_sketches(encuesta, campos_respuesta):
+    """
+    Registra los valores de una respuesta ({clave: CampoRespuesta}) para los SketchCampo de la encuesta.
+    Solo inserta un SketchPendiente: los resúmenes compartidos los actualiza consolidar_sketches por lotes,
+    así los envíos concurrentes no compiten por las mismas filas.
+    Las ediciones no se vuelven a contar: los resúmenes reflejan los valores enviados.
+    """
+    valores = {
+        str(campo.campo_definido_id): [campo.valor, campo.valor_numerico]
+        for campo in campos_respuesta.values() if not es_valor_vacio(campo.valor)
+    }
+    if valores:
+        SketchPendiente.objects.create(encuesta_id=encuesta.pk, valores=valores)
+
+
+def consolidar_sketches(tamano_lote=1000):
+    """
+    Agrega a los SketchCampo un lote de SketchPendiente y los elimina, en una transacción. Los pendientes
+    se toman con SKIP LOCKED cuando la base lo soporta, y cada SketchCampo se bloquea una vez por lote
+    (en orden, para evitar interbloqueos entre consolidaciones). Retorna los pendientes agregados.
+    """
+    with transaction.atomic():
+        pendientes = list(
+            SketchPendiente.objects
+            .select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+            .order_by('id')[:tamano_lote]
+        )
+        if not pendientes:
+            return 0
+
+        por_sketch = {}
+        for pendiente in pendientes:
+            for campo_definido_id, (valor, valor_numerico) in pendiente.valores.items():
+                por_sketch.setdefault((pendiente.encuesta_id, int(campo_definido_id)), []).append((valor, valor_numerico))
+
+        campos_definidos = {campo_definido_id for _, campo_definido_id in por_sketch}
+        tipos = dict(CampoDefinido.objects.filter(id__in=campos_definidos).values_list('id', 'tipo'))
+        por_sketch = {clave: valores for clave, valores in por_sketch.items() if clave[1] in tipos}
+
+        SketchCampo.objects.bulk_create(
+            [SketchCampo(encuesta_id=encuesta_id, campo_definido_id=campo_definido_id) for encuesta_id, campo_definido_id in por_sketch],
+            ignore_conflicts=True
+        )
+        sketches = SketchCampo.objects.select_for_update().filter(
+            encuesta_id__in={encuesta_id for encuesta_id, _ in por_sketch}, campo_definido_id__in=campos_definidos
+        ).order_by('encuesta_id', 'campo_definido_id')
+
+        for sketch in sketches:
+            valores = por_sketch.get((sketch.encuesta_id, sketch.campo_definido_id))
+            if not valores:
+                continue
+            _agregar_a_sketches(sketch, valores, tipos[sketch.campo_definido_id])
+            sketch.save(update_fields=['total', 'distintos', 'cuantiles', 'frecuentes'])
+
+        SketchPendiente.objects.filter(pk__in=[pendiente.pk for pendiente in pendientes]).delete()
+        return len(pendientes)
+
+
+def reconstruir_sketches(encuesta, tamano_lote=1000):
+    """
+    Recalcula desde cero los SketchCampo de una encuesta (p. ej. al activar el modo aproximado).
+    Los SketchPendiente de la encuesta existentes al empezar se descartan: sus respuestas ya se recorren.
+    """
+    ultimo_pendiente = SketchPendiente.objects.filter(encuesta=encuesta).aggregate(maximo=Max('id'))['maximo']
+    campos_definidos = list(CampoDefinido.objects.filter(formulario_id=encuesta.formulario_id))
+    por_clave = {campo.clave: campo for campo in campos_definidos}
+    sketches = {campo.id: SketchCampo(encuesta=encuesta, campo_definido=campo) for campo in campos_definidos}
+
+    respuestas = RespuestaEncuesta.objects.filter(encuesta=encuesta)
+    for respuesta in iterar_respuestas_por_lotes(respuestas, tamano_lote):
+        for clave, campo in obtener_campos_respuesta(respuesta, por_clave).items():
+            if clave in por_clave and not es_valor_vacio(campo.valor):
+                _agregar_a_sketches(sketches[por_clave[clave].id], [(campo.valor, campo.valor_numerico)], por_clave[clave].tipo)
+
+    with transaction.atomic():
+        if ultimo_pendiente is not None:
+            SketchPendiente.objects.filter(encuesta=encuesta, id__lte=ultimo_pendiente).delete()
+        SketchCampo.objects.filter(encuesta=encuesta).delete()
+        SketchCampo.objects.bulk_create([sketch for sketch in sketches.values() if sketch.total])
+
+
+def estadisticas_aproximadas(campo_definido, encuestas=None, cuantiles=(0.25, 0.5, 0.75, 0.9, 0.99), top=10):
+    """
+    Combina los SketchCampo de un campo en todas las encuestas de su formulario (o en las indicadas)
+    y devuelve {'total', 'distintos', 'cuantiles': {q: valor}, 'frecuentes': [(valor, conteo)]}.
+    """
+    sketches = SketchCampo.objects.filter(campo_definido=campo_definido)
+    if encuestas is not None:
+        sketches = sketches.filter(encuesta__in=encuestas)
+
+    total = 0
+    distintos, kll, frecuentes = HyperLogLog(), KLL(), EspacioAhorro()
+    for sketch in sketches:
+        total += sketch.total
+        if sketch.distintos:
+            distintos.combinar(HyperLogLog.desde_dict(sketch.distintos))
+        if sketch.cuantiles:
+            kll.combinar(KLL.desde_dict(sketch.cuantiles))
+        if sketch.frecuentes:
+            frecuentes.combinar(EspacioAhorro.desde_dict(sketch.frecuentes))
+
+    return {
+        'total': total,
+        'distintos': distintos.estimar() if total else 0,
+        'cuantiles': {q: kll.cuantil(q) for q in cuantiles} if kll.n else {},
+        'frecuentes': frecuentes.frecuentes(top),
+    }
+
+
+def registrar_evento_salida(respuesta, tipo):
+    """
+    Agrega un evento al outbox (si CUSTOM_FORMS_OUTBOX_ACTIVO). Debe llamarse dentro de la misma
+    transacción que guarda la respuesta para que el evento exista si y solo si la respuesta existe.
+    """
+    if not getattr(settings, 'CUSTOM_FORMS_OUTBOX_ACTIVO', False):
+        return None
+
+    return EventoSalida.objects.create(
+        tipo=tipo,
+        encuesta_id=respuesta.encuesta_id,
+        respuesta_id=respuesta.pk,
+        payload={
+            'respuesta_id': respuesta.pk,
+            'encuesta_id': respuesta.encuesta_id,
+            'formulario_id': respuesta.encuesta.formulario_id,
+            'version': respuesta.version,
+            'usuario_id': respuesta.usuario_id,
+            'enviado': respuesta.enviado.isoformat() if respuesta.enviado else None,
+            'datos': obtener_datos_respuesta(respuesta),
+        },
+    )
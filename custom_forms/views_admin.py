@@ -1,21 +1,38 @@
-import json
+import csv, json
 from datetime import datetime
 
+from django.core.paginator import Paginator
+from django.http import JsonResponse, StreamingHttpResponse
 from django.shortcuts import render, redirect
 from django.contrib import messages
-from django.db.models import Q
+from django.db import transaction, IntegrityError
+from django.db.models import Q, Count, Sum, Max
+from django.db.models.functions import Coalesce
 
 from core.views import ViewAdministracionBase
 from core.utils import error_json, success_json, get_redirect_url
 
-from .utils import guardar_o_actualizar_campos_respuesta, actualizar_formulario_y_guardar_version
+from .utils import (
+    guardar_o_actualizar_campos_respuesta, actualizar_formulario_y_guardar_version,
+    obtener_valores_respuesta, campos_visibles_para, filtrar_campos_visibles,
+    iterar_respuestas_por_lotes, registrar_envio_en_resumen, valores_tabla_respuestas,
+    actualizar_contadores_encuesta, total_campos_activos_subquery, actualizar_sketches, obtener_campos_respuesta,
+    registrar_evento_salida, obtener_snapshot_respuesta, precargar_snapshots, respuestas_adyacentes,
+    obtener_schema_version, etiquetas_version, formularios_vigentes, encuestas_vigentes, respuestas_vigentes
+)
 
-from .models import Formulario, Encuesta, RespuestaEncuesta, FormularioVersion
+from .routers import lectura_en_replica, fijar_primaria, alias_lectura
+from .envios import EnvioJSON, LimiteEnvioExcedido, es_cuerpo_json, resolver_archivados
+from .models import Formulario, Encuesta, RespuestaEncuesta, FormularioVersion, CampoDefinido
 from .forms import FormularioForm, EncuestaForm
 
+RESULTADOS_POR_PAGINA = 50
+LISTADO_POR_PAGINA = 25
+
 class FormularioAdminView(ViewAdministracionBase):
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
+        fijar_primaria(request)  # Read-after-write: la siguiente lectura no debe ir a la réplica
         if self.action and hasattr(self, f'post_{self.action}'):
             return getattr(self, f'post_{self.action}')(request, context, *args, **kwargs)
         return error_json(mensaje="Acción no permitida")
@@ -42,7 +59,7 @@ class FormularioAdminView(ViewAdministracionBase):
             return error_json(mensaje="Error al crear el formulario", forms=[form])
         
     def post_edit(self, request, context, *args, **kwargs):
-        object = Formulario.objects.get(pk=self.data.get('id', None))
+        object = formularios_vigentes().get(pk=self.data.get('id', None))
         form = FormularioForm(request.POST, instance=object)
         if form.is_valid():
             object = form.save(commit=False)
@@ -55,7 +72,7 @@ class FormularioAdminView(ViewAdministracionBase):
             except json.JSONDecodeError:
                 return error_json(mensaje="El esquema no es un JSON válido")
             
-            actualizar_formulario_y_guardar_version(object, schema)
+            actualizar_formulario_y_guardar_version(object, schema, campos=FormularioForm.Meta.fields)
 
             mensaje = "Formulario editado exitosamente"
             messages.success(request, mensaje)
@@ -65,8 +82,10 @@ class FormularioAdminView(ViewAdministracionBase):
 
     def post_delete(self, request, context, *args, **kwargs):
         id = self.data.get('id', None)
-        object = Formulario.objects.get(id=id)
-        object.delete()
+        object = formularios_vigentes().get(id=id)
+        # Se oculta de inmediato; las respuestas se purgan por lotes con `purgar_eliminados`
+        object.eliminacion_pendiente = True
+        object.save(update_fields=['eliminacion_pendiente'])
         messages.success(request, "Formulario eliminado exitosamente")
         return success_json(mensaje="Formulario eliminado exitosamente", url=get_redirect_url(request, object))
     
@@ -75,7 +94,18 @@ class FormularioAdminView(ViewAdministracionBase):
         if self.action and hasattr(self, f'get_{self.action}'):
             return getattr(self, f'get_{self.action}')(request, context, *args, **kwargs)
 
-        context['objects'] = Formulario.objects.all()
+        encuesta_vigente = Q(encuesta__eliminacion_pendiente=False)
+        objects = formularios_vigentes().annotate(
+            total_campos=total_campos_activos_subquery(),
+            total_encuestas=Count('encuesta', filter=encuesta_vigente),
+            total_respuestas=Coalesce(Sum('encuesta__total_respuestas', filter=encuesta_vigente), 0),
+            ultima_respuesta=Max('encuesta__ultima_respuesta', filter=encuesta_vigente),
+        ).order_by('-fecha', '-id')
+        if search := request.GET.get('search'):
+            objects = objects.filter(nombre__icontains=search)
+
+        context['page_obj'] = page_obj = Paginator(objects, LISTADO_POR_PAGINA).get_page(request.GET.get('page'))
+        context['objects'] = page_obj.object_list
         return render(request, 'custom_forms/admin/lista.html', context)
     
     def get_add(self, request, context, *args, **kwargs):
@@ -83,31 +113,33 @@ class FormularioAdminView(ViewAdministracionBase):
         return render(request, 'custom_forms/admin/form_formulario.html', context)
     
     def get_edit(self, request, context, *args, **kwargs):
-        object = Formulario.objects.get(pk=self.data.get('id', None))
+        object = formularios_vigentes().get(pk=self.data.get('id', None))
         context['form'] = FormularioForm(instance=object)
         context['object'] = object
         return render(request, 'custom_forms/admin/form_formulario.html', context)
     
+    @lectura_en_replica
     def get_versiones(self, request, context, *args, **kwargs):
-        object = Formulario.objects.get(pk=self.data.get('id', None))
+        object = formularios_vigentes().get(pk=self.data.get('id', None))
         context['object'] = object
         context['versiones'] = object.versiones.all()
         return render(request, 'custom_forms/admin/versiones.html', context)
     
+    @lectura_en_replica
     def get_ver_version(self, request, context, *args, **kwargs):
-        object = FormularioVersion.objects.get(pk=self.data.get('id', None))
+        object = FormularioVersion.objects.filter(formulario__eliminacion_pendiente=False).get(pk=self.data.get('id', None))
         context['object'] = object
         return render(request, 'custom_forms/admin/ver_version.html', context)
     
     def get_generar_modelo_django(self, request, context, *args, **kwargs):
-        object = Formulario.objects.get(pk=self.data.get('id', None))
+        object = formularios_vigentes().get(pk=self.data.get('id', None))
         context['object'] = object
         context['modelo_code'] = object.generar_modelo_django()
         return render(request, 'custom_forms/admin/generar_modelo.html', context)
 
     def get_delete(self, request, context, *args, **kwargs):
         id = self.data.get('id', None)
-        object = Formulario.objects.get(id=id)
+        object = formularios_vigentes().get(id=id)
         context['title'] = "Eliminar registro"
         context['message'] = f'¿Está seguro de que desea eliminar el registro: {object}?"'
         context['formid'] = object.id 
@@ -118,6 +150,11 @@ class FormularioAdminView(ViewAdministracionBase):
 class EncuestaAdminView(ViewAdministracionBase):
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
+        fijar_primaria(request)  # Read-after-write: la siguiente lectura no debe ir a la réplica
+        if es_cuerpo_json(request):
+            # El cuerpo es el objeto de respuestas (se lee por partes): action, id y clave_envio van en la URL
+            self.data = request.GET
+            self.action = request.GET.get('action', self.action)
         if self.action and hasattr(self, f'post_{self.action}'):
             return getattr(self, f'post_{self.action}')(request, context, *args, **kwargs)
         return error_json(mensaje="Acción no permitida")
@@ -135,7 +172,7 @@ class EncuestaAdminView(ViewAdministracionBase):
             return error_json(mensaje="Error al crear la encuesta", forms=[form])
         
     def post_edit(self, request, context, *args, **kwargs):
-        object = Encuesta.objects.get(pk=self.data.get('id', None))
+        object = encuestas_vigentes().get(pk=self.data.get('id', None))
         form = EncuestaForm(request.POST, instance=object)
         if form.is_valid():
             object = form.save()
@@ -146,45 +183,123 @@ class EncuestaAdminView(ViewAdministracionBase):
 
     def post_delete(self, request, context, *args, **kwargs):
         id = self.data.get('id', None)
-        object = Encuesta.objects.get(id=id)
-        object.delete()
+        object = encuestas_vigentes().get(id=id)
+        # Se oculta de inmediato; las respuestas se purgan por lotes con `purgar_eliminados`
+        object.eliminacion_pendiente = True
+        object.save(update_fields=['eliminacion_pendiente'])
         messages.success(request, "Formulario eliminado exitosamente")
         return success_json(mensaje="Formulario eliminado exitosamente", url=get_redirect_url(request, object))
     
     def post_responder_encuesta(self, request, context, *args, **kwargs):
-        encuesta = Encuesta.objects.get(pk=self.data.get('id', None))
-        respuestas = json.loads(request.POST.get('respuestas', None))
+        encuesta = encuestas_vigentes().get(pk=self.data.get('id', None))
+        clave_envio = self.data.get('clave_envio') or None
+        mensaje = "Encuesta respondida exitosamente"
+        usuario = request.user if request.user.is_authenticated else None
+        # Solo cuenta como reenvío una respuesta de esta encuesta y de este usuario con la misma clave
+        reenvios = RespuestaEncuesta.objects.filter(clave_envio=clave_envio, encuesta=encuesta, usuario=usuario)
 
-        respuesta = RespuestaEncuesta.objects.create(
-            encuesta=encuesta,
-            usuario=request.user if request.user.is_authenticated else None,
-            version=encuesta.formulario.version
-        )
+        # Reenvío (doble clic o reintento tras un timeout): ya está guardado
+        if clave_envio and reenvios.exists():
+            messages.success(request, mensaje)
+            return success_json(mensaje=mensaje, url=get_redirect_url(request, encuesta))
 
-        errores = guardar_o_actualizar_campos_respuesta(respuesta, respuestas)
-        if errores:
-            raise ValueError("Error al guardar las respuestas: " + str(errores))
-        
-        messages.success(request, "Encuesta respondida exitosamente")
-        return success_json(mensaje="Encuesta respondida exitosamente", url=get_redirect_url(request, encuesta))
+        # Las respuestas se leen campo a campo mientras se guardan
+        envio = EnvioJSON(request)
+
+        try:
+            with transaction.atomic():
+                respuesta = RespuestaEncuesta.objects.create(
+                    encuesta=encuesta,
+                    usuario=usuario,
+                    version=encuesta.formulario.version,
+                    clave_envio=clave_envio
+                )
+
+                errores = guardar_o_actualizar_campos_respuesta(respuesta, envio.pares())
+                if errores:
+                    raise ValueError("Error al guardar las respuestas: " + str(errores))
+                registrar_evento_salida(respuesta, 'respuesta.creada')
+        except LimiteEnvioExcedido as e:
+            envio.descartar_archivados()
+            return error_json(mensaje=str(e))
+        except IntegrityError:
+            envio.descartar_archivados()
+            # Un envío con la misma clave se guardó en paralelo
+            if clave_envio and reenvios.exists():
+                messages.success(request, mensaje)
+                return success_json(mensaje=mensaje, url=get_redirect_url(request, encuesta))
+            if clave_envio and RespuestaEncuesta.objects.filter(clave_envio=clave_envio).exists():
+                return error_json(mensaje="La clave de envío ya se usó en otra respuesta")
+            raise
+        except Exception:
+            envio.descartar_archivados()
+            raise
+
+        registrar_envio_en_resumen(respuesta)
+        actualizar_contadores_encuesta(respuesta)
+        if encuesta.estadisticas_aproximadas:
+            actualizar_sketches(encuesta, obtener_campos_respuesta(respuesta))
+
+        messages.success(request, mensaje)
+        return success_json(mensaje=mensaje, url=get_redirect_url(request, encuesta))
     
     def post_edit_resultado(self, request, context, *args, **kwargs):
-        respuesta = RespuestaEncuesta.objects.get(pk=self.data.get('id_respuesta', None))
-        respuestas = json.loads(request.POST.get('respuestas', None))
+        respuesta = respuestas_vigentes().get(pk=self.data.get('id_respuesta', None))
+        clave_envio = self.data.get('clave_envio') or None
+        mensaje = "Encuesta editada exitosamente"
 
-        errores = guardar_o_actualizar_campos_respuesta(respuesta, respuestas)
-        if errores:
-            raise ValueError("Error al guardar las respuestas: " + str(errores))
-        
-        messages.success(request, "Encuesta editada exitosamente")
-        return success_json(mensaje="Encuesta editada exitosamente", url=get_redirect_url(request, respuesta, self.action))
+        # Reenvío de la misma edición ya aplicada (se vuelve a comprobar con la fila bloqueada)
+        if clave_envio and respuesta.ultima_clave_edicion == clave_envio:
+            messages.success(request, mensaje)
+            return success_json(mensaje=mensaje, url=get_redirect_url(request, respuesta, self.action))
+
+        envio = EnvioJSON(request)
+
+        # Los campos ocultos para el usuario no se muestran al editar: no deben sobrescribirse
+        visibles = campos_visibles_para(respuesta.encuesta.formulario, request.user)
+        respuestas = filtrar_campos_visibles(envio.pares(), visibles)
+
+        try:
+            with transaction.atomic():
+                # Vuelve a leer la respuesta bloqueada (la purga también la bloquea antes de borrar sus filas)
+                # y comprueba que su encuesta no se haya marcado para eliminación mientras tanto
+                encuesta = respuesta.encuesta
+                respuesta = RespuestaEncuesta.objects.select_for_update().get(pk=respuesta.pk)
+                respuesta.encuesta = encuesta
+                if not respuestas_vigentes().filter(pk=respuesta.pk).exists():
+                    raise RespuestaEncuesta.DoesNotExist("La respuesta ya no existe")
+                # Dos envíos iguales en paralelo pasan la comprobación de arriba: con la fila bloqueada,
+                # el segundo ve la clave del primero y no aplica la edición ni emite otro evento
+                if not (clave_envio and respuesta.ultima_clave_edicion == clave_envio):
+                    errores = guardar_o_actualizar_campos_respuesta(respuesta, respuestas)
+                    if errores:
+                        raise ValueError("Error al guardar las respuestas: " + str(errores))
+                    if clave_envio:
+                        RespuestaEncuesta.objects.filter(pk=respuesta.pk).update(ultima_clave_edicion=clave_envio)
+                    registrar_evento_salida(respuesta, 'respuesta.editada')
+        except LimiteEnvioExcedido as e:
+            envio.descartar_archivados()
+            return error_json(mensaje=str(e))
+        except Exception:
+            envio.descartar_archivados()
+            raise
+
+        messages.success(request, mensaje)
+        return success_json(mensaje=mensaje, url=get_redirect_url(request, respuesta, self.action))
     
     def get(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
         if self.action and hasattr(self, f'get_{self.action}'):
             return getattr(self, f'get_{self.action}')(request, context, *args, **kwargs)
 
-        context['objects'] = Encuesta.objects.all()
+        objects = encuestas_vigentes().select_related('formulario').annotate(
+            total_campos=total_campos_activos_subquery('formulario'),
+        ).order_by('-creada_en', '-id')
+        if search := request.GET.get('search'):
+            objects = objects.filter(Q(nombre__icontains=search) | Q(descripcion__icontains=search))
+
+        context['page_obj'] = page_obj = Paginator(objects, LISTADO_POR_PAGINA).get_page(request.GET.get('page'))
+        context['objects'] = page_obj.object_list
         return render(request, 'custom_forms/admin/lista_encuestas.html', context)
     
     def get_add(self, request, context, *args, **kwargs):
@@ -192,67 +307,125 @@ class EncuestaAdminView(ViewAdministracionBase):
         return render(request, 'core/forms/formAdmin.html', context)
     
     def get_edit(self, request, context, *args, **kwargs):
-        object = Encuesta.objects.get(pk=self.data.get('id', None))
+        object = encuestas_vigentes().get(pk=self.data.get('id', None))
         context['form'] = EncuestaForm(instance=object)
         context['object'] = object
         return render(request, 'core/forms/formAdmin.html', context)
     
     def get_responder_encuesta(self, request, context, *args, **kwargs):
-        context['encuesta'] = encuesta = Encuesta.objects.get(pk=self.data.get('id', None))
+        context['encuesta'] = encuesta = encuestas_vigentes().get(pk=self.data.get('id', None))
         context['formulario'] = encuesta.formulario
         return render(request, 'custom_forms/admin/responder_encuesta.html', context)
     
+    @lectura_en_replica
     def get_resultados(self, request, context, *args, **kwargs):
-        context['object'] = encuesta = Encuesta.objects.get(pk=self.data.get('id', None))
-        respuestas = RespuestaEncuesta.objects.filter(encuesta=encuesta).prefetch_related('campos')
+        context['object'] = encuesta = encuestas_vigentes().select_related('formulario').get(pk=self.data.get('id', None))
+        visibles = campos_visibles_para(encuesta.formulario, request.user)
+
+        # Solo las columnas `table_view`; el resto se carga al expandir la fila (get_campos_resultado)
+        columnas = encuesta.formulario.campos_tabla().order_by('id')
+        if visibles is not None:
+            columnas = columnas.filter(id__in=visibles.keys())
+        columnas = list(columnas)
+
+        respuestas = RespuestaEncuesta.objects.filter(encuesta=encuesta).select_related('usuario').order_by('-enviado', '-id')
+        page_obj = Paginator(respuestas, RESULTADOS_POR_PAGINA).get_page(request.GET.get('page'))
+        filas = list(page_obj.object_list)
+        valores = valores_tabla_respuestas(filas, columnas)
 
         resultados = []
-        for respuesta in respuestas:
+        for respuesta in filas:
             fila = {
                 'id': respuesta.id,
                 'usuario': respuesta.usuario,
                 'fecha': respuesta.enviado,
-                'campos': {campo.clave: campo.valor for campo in respuesta.campos.all()}
+                'campos': [valores.get(respuesta.id, {}).get(columna.clave, '') for columna in columnas]
             }
             resultados.append(fila)
+        context['columnas'] = columnas
+        context['page_obj'] = page_obj
         context['resultados'] = resultados
         return render(request, 'custom_forms/admin/resultados.html', context)
     
-    def get_ver_resultado(self, request, context, *args, **kwargs):
-        context['object'] = respuesta = RespuestaEncuesta.objects.get(pk=self.data.get('id', None))
-        version_obj = FormularioVersion.objects.filter(
-            formulario=respuesta.encuesta.formulario,
-            numero=respuesta.version
-        ).first()
-
-        schema = version_obj.json if version_obj else respuesta.encuesta.formulario.json
-        # Convertir los campos a un dict {clave: valor} para pasar a Formio
-        submission_data = {campo.clave: json.loads(campo.valor) if campo.valor.startswith('[') or campo.valor.startswith('{') else campo.valor for campo in respuesta.campos.all()}
-        context['schema'] = schema
-        context['submission'] = submission_data
-        context['formulario'] = respuesta.encuesta.formulario
+    @lectura_en_replica
+    def get_campos_resultado(self, request, context, *args, **kwargs):
+        respuesta = respuestas_vigentes().select_related('encuesta__formulario').get(pk=self.data.get('id', None))
+        formulario = respuesta.encuesta.formulario
+        valores = filtrar_campos_visibles(
+            obtener_valores_respuesta(respuesta),
+            campos_visibles_para(formulario, request.user, respuesta.version)
+        )
+        etiquetas = dict(CampoDefinido.objects.filter(formulario=formulario, clave__in=valores.keys()).values_list('clave', 'etiqueta'))
+        etiquetas.update(etiquetas_version(formulario.id, respuesta.version))  # Etiquetas de la versión respondida
+        return JsonResponse({
+            'campos': [{'etiqueta': etiquetas.get(clave, clave), 'valor': valor} for clave, valor in valores.items()]
+        })
+
+    def _contexto_resultado(self, request, context):
+        respuesta = respuestas_vigentes().select_related('encuesta__formulario').defer(
+            'datos', 'encuesta__formulario__json'
+        ).get(pk=self.data.get('id', None))
+        formulario = respuesta.encuesta.formulario
+
+        # Snapshot cacheado del envío y schema de su versión: sin leer CampoRespuesta ni parsear valores
+        context['object'] = respuesta
+        context['schema'] = obtener_schema_version(formulario.pk, respuesta.version)
+        context['submission'] = resolver_archivados(filtrar_campos_visibles(
+            obtener_snapshot_respuesta(respuesta),
+            campos_visibles_para(formulario, request.user, respuesta.version)
+        ))
+        context['formulario'] = formulario
         context['encuesta'] = respuesta.encuesta
+
+        # Quien revisa suele pasar a la respuesta contigua: dejarla precargada
+        context['anterior_id'], context['siguiente_id'] = respuestas_adyacentes(respuesta)
+        precargar_snapshots([context['anterior_id'], context['siguiente_id']])
+        return context
+
+    @lectura_en_replica
+    def get_ver_resultado(self, request, context, *args, **kwargs):
+        context = self._contexto_resultado(request, context)
         context['informativo'] = True # Solo visualización del formulario
         return render(request, 'custom_forms/admin/responder_encuesta.html', context)
         # return render(request, 'custom_forms/admin/ver_resultado.html', context)
     
 
     def get_edit_resultado(self, request, context, *args, **kwargs):
-        context['object'] = respuesta = RespuestaEncuesta.objects.get(pk=self.data.get('id', None))
-        version_obj = FormularioVersion.objects.filter(formulario=respuesta.encuesta.formulario, numero=respuesta.version).first()
-
-        schema = version_obj.json if version_obj else respuesta.encuesta.formulario.json
-        # Convertir los campos a un dict {clave: valor} para pasar a Formio
-        submission_data = {campo.clave: json.loads(campo.valor) if campo.valor.startswith('[') or campo.valor.startswith('{') else campo.valor for campo in respuesta.campos.all()}
-        context['schema'] = schema
-        context['submission'] = submission_data
-        context['formulario'] = respuesta.encuesta.formulario
-        context['encuesta'] = respuesta.encuesta
+        context = self._contexto_resultado(request, context)
         return render(request, 'custom_forms/admin/responder_encuesta.html', context)
 
+    def get_exportar_resultados(self, request, context, *args, **kwargs):
+        alias = alias_lectura(request)  # Las filas se leen después de retornar la respuesta
+        encuesta = encuestas_vigentes(alias).select_related('formulario').get(pk=self.data.get('id', None))
+        visibles = campos_visibles_para(encuesta.formulario, request.user)
+        campos = CampoDefinido.objects.using(alias).filter(formulario=encuesta.formulario, activo=True).order_by('id')
+        if visibles is not None:
+            campos = campos.filter(id__in=visibles.keys())
+        campos = list(campos)
+
+        class Echo:
+            def write(self, value):
+                return value
+
+        writer = csv.writer(Echo())
+
+        def filas():
+            yield writer.writerow(['ID', 'Usuario', 'Fecha'] + [campo.etiqueta for campo in campos])
+            respuestas = RespuestaEncuesta.objects.using(alias).filter(encuesta=encuesta).select_related('usuario')
+            for respuesta in iterar_respuestas_por_lotes(respuestas):
+                valores = obtener_valores_respuesta(respuesta)
+                yield writer.writerow(
+                    [respuesta.id, respuesta.usuario or '', respuesta.enviado.strftime('%Y-%m-%d %H:%M')] +
+                    [valores.get(campo.clave, '') for campo in campos]
+                )
+
+        response = StreamingHttpResponse(filas(), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="resultados_encuesta_{encuesta.id}.csv"'
+        return response
+
     def get_delete(self, request, context, *args, **kwargs):
         id = self.data.get('id', None)
-        object = Encuesta.objects.get(id=id)
+        object = encuestas_vigentes().get(id=id)
         context['title'] = "Eliminar registro"
         context['message'] = f'¿Está seguro de que desea eliminar el registro: {object}?"'
         context['formid'] = object.id 